@@ -0,0 +1,368 @@
+"""Headless throughput benchmarks for the terminal emulation.
+
+Run them with:
+
+    $ python -m schirm.benchmark
+
+The stream benchmarks measure the SchirmStream parsers alone. The
+pipeline benchmarks feed the traces through SchirmStream, TermScreen,
+BrowserScreen.pop_events and json.dumps like
+Terminal.input and Terminal.render do, without Qt or webkitwindow.
+
+The built-in traces are not recordings. They are generated, to keep
+binary pty dumps out of the repository, and imitate the escape
+sequences of plain output, `ls --color`, vim, htop and schirmclient
+iframes. Recorded pty output, e.g. from `script -q -c htop htop.trace`,
+can be benchmarked by passing the file name instead of a trace name.
+
+The channel benchmarks (--chan) measure the chan.Chan operations
+used to pass pty output and browser messages between threads, and
+the latency from a keypress message to its echo by the pty, when
+messages are handed to the dispatch loop by a thread each (like
+SchirmHandler used to) or by a utils.Forwarder.
+"""
+import os
+import sys
+import json
+import time
+import random
+import base64
+import pickle
+import resource
+import argparse
+import threading
+
+import chan
+import utils
+import terminalio
+import termscreen
+import browserscreen
+
+# schirmclient lives in support/, it is not part of the package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'support'))
+import schirmclient
+
+# synthetic pty output traces
+
+def plain_trace(lines=20000):
+    return ''.join('%d some plain text line with words %s\r\n' % (i, 'x' * (i % 70))
+                   for i in xrange(lines))
+
+def ls_trace(lines=10000, seed=0):
+    """Colored `ls --color` output."""
+    rnd = random.Random(seed)
+    colors = ['01;34', '01;32', '00', '01;36', '40;31;01', '38;5;208', '48;5;17;38;5;231']
+    res = []
+    for i in xrange(lines):
+        for j in range(6):
+            res.append('\x1b[0m\x1b[%sm%s\x1b[0m  ' % (rnd.choice(colors), 'file-%d-%d.txt' % (i, j)))
+        res.append('\r\n')
+    return ''.join(res)
+
+def vim_trace(frames=600, lines=24, columns=80):
+    """Full screen redraws of a `vim` editing session."""
+    res = ['\x1b[?1049h\x1b[?1h\x1b=\x1b[1;%dr\x1b[H\x1b[2J' % lines]
+    for frame in xrange(frames):
+        res.append('\x1b[?25l')
+        for y in range(1, lines):
+            text = 'def foo_%d(x): return x * %d  # \xc3\xbcn\xc3\xafc\xc3\xb6d\xc3\xa9' % (y, frame)
+            res.append('\x1b[%d;1H\x1b[33m%3d \x1b[m%s\x1b[K' % (y, y + frame, text[:columns-4]))
+        res.append('\x1b[%d;1H\x1b[7m-- INSERT --\x1b[m' % lines)
+        res.append('\x1b[%d;%dH\x1b[?25h' % (frame % (lines - 1) + 1, frame % (columns - 20) + 5))
+    res.append('\x1b[?1049l')
+    return ''.join(res)
+
+def vim_scroll_trace(steps=3000, lines=24, columns=80):
+    """Scrolling through a file line by line in `vim`."""
+    res = ['\x1b[?1049h\x1b[?1h\x1b=\x1b[1;%dr\x1b[H\x1b[2J' % (lines - 1)]
+    for step in xrange(steps):
+        text = 'line %d: some source code \x1b[32m"a string"\x1b[m' % step
+        # scroll the region above the status line, draw the new last line
+        res.append('\x1b[?25l\x1b[%d;1H\n\x1b[33m%5d \x1b[m%s\x1b[K' % (lines - 1, step, text))
+        res.append('\x1b[%d;1H\x1b[K%d,1%s%d%%' % (lines, step, ' ' * 10, step * 100 / steps))
+        res.append('\x1b[%d;1H\x1b[?25h' % (lines - 1))
+    res.append('\x1b[r\x1b[?1049l')
+    return ''.join(res)
+
+def htop_trace(frames=300, lines=24, columns=80, seed=0):
+    """Partial, colored screen updates of `htop`."""
+    rnd = random.Random(seed)
+    res = ['\x1b[?1049h\x1b[1;%dr\x1b[?25l\x1b[H\x1b[2J' % lines]
+    for frame in xrange(frames):
+        # cpu and memory meters
+        for y in range(1, 5):
+            used = rnd.randint(0, 40)
+            res.append('\x1b[%d;3H\x1b[1m\x1b[36m%-3d\x1b[m\x1b[1m[\x1b[32m%s\x1b[31m%s\x1b[m%s\x1b[1m]\x1b[m'
+                       % (y, y, '|' * (used / 2), '|' * (used - used / 2), ' ' * (40 - used)))
+        # process list header and rows
+        res.append('\x1b[7;1H\x1b[30m\x1b[42m  PID USER      PRI  NI  VIRT   RES   SHR S CPU%% MEM%%   TIME+  Command%s\x1b[m'
+                   % (' ' * (columns - 71)))
+        for y in range(8, lines):
+            res.append('\x1b[%d;1H%5d \x1b[1m%-9s\x1b[m  20   0 \x1b[36m%5dM\x1b[m %5d  %4d S %4.1f %4.1f  0:%02d.%02d \x1b[1m%s\x1b[m\x1b[K'
+                       % (y, rnd.randint(1, 32768), rnd.choice(['root', 'user']), rnd.randint(10, 999),
+                          rnd.randint(1, 9999), rnd.randint(1, 999), rnd.random() * 100, rnd.random() * 10,
+                          frame % 60, rnd.randint(0, 99), rnd.choice(['bash', 'python', 'schirm', 'htop'])))
+        # function key bar
+        res.append('\x1b[%d;1HF1\x1b[30m\x1b[46mHelp  \x1b[mF10\x1b[30m\x1b[46mQuit  \x1b[m' % lines)
+    res.append('\x1b[?25h\x1b[?1049l')
+    return ''.join(res)
+
+def iframe_trace(frames=200, rows=50):
+    """Html tables written into iframes using schirmclient.
+
+    Like schirmclient.frame, without writing to the pty and toggling
+    the terminal echo.
+    """
+    def request(header, body):
+        # see schirmclient._write_request
+        return ''.join((schirmclient.STR_START,
+                        json.dumps(header), "\n\n", base64.b64encode(body),
+                        schirmclient.STR_END))
+
+    css = 'td { font-family: monospace; }\n' * 50
+    res = []
+    for frame in xrange(frames):
+        res.append(schirmclient._set_mode_str(schirmclient.DOCUMENT_MODE, cookie='1234567890'))
+        res.append(request({'x-schirm-path': 'table.css', 'Content-Type': 'text/css'}, css))
+        res.append('<html><head><link rel="stylesheet" href="table.css"></head><body><table>\n')
+        for row in range(rows):
+            res.append('<tr><td>%d</td><td>row %d</td><td>%s</td></tr>\n' % (frame, row, 'x' * (row % 30)))
+        res.append('</table></body></html>')
+        res.append(schirmclient._set_mode_str(schirmclient.RESPONSE_MODE, cookie='1234567890'))
+        res.append(request({'x-schirm-debug': ''}, 'frame %d done' % frame))
+        res.append(schirmclient._reset_mode_str(schirmclient.DOCUMENT_MODE))
+        res.append('\n$ ')
+    return ''.join(res)
+
+TRACES = {
+    'plain': plain_trace,
+    'ls': ls_trace,
+    'vim': vim_trace,
+    'vimscroll': vim_scroll_trace,
+    'htop': htop_trace,
+    'iframe': iframe_trace,
+}
+
+# seconds between rendered frames, see terminal.Terminal.FRAME_INTERVAL
+FRAME_INTERVAL = 0.016
+
+def chunks(data, size=4096):
+    """Split data into pty read sized chunks."""
+    return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+# benchmarks
+
+class NullScreen(object):
+    """A screen ignoring all events, to measure the stream alone."""
+
+    def __getattr__(self, name):
+        return self._ignore
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+def bench_stream(data, repeat=3, parser='statemachine'):
+    """Return the chars/sec the given SchirmStream parses data with."""
+    best = None
+    for _ in range(repeat):
+        stream = termscreen.STREAMS[parser]()
+        stream.attach(NullScreen())
+        parts = chunks(data)
+        start = time.time()
+        for part in parts:
+            stream.feed(part)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(data) / best
+
+def bench_pipeline(data, parser='statemachine', lines=24, columns=80):
+    """Run data through the whole emulation, rendering once per frame.
+
+    Output arrives faster than it is parsed, so like Terminal it is
+    rendered every FRAME_INTERVAL seconds and once at the end.
+
+    Return a dict of input bytes/sec, render events/sec, json bytes
+    per input byte.
+    """
+    screen = termscreen.TermScreen(columns, lines)
+    stream = termscreen.STREAMS[parser]()
+    stream.attach(screen)
+    screen.pop_events() # initial reset
+    encode = browserscreen.JsonEncoder().encode
+    parts = chunks(data)
+    counts = {'events': 0, 'sent_bytes': 0}
+
+    def render():
+        # see Terminal.render
+        term_events = screen.pop_events()
+        counts['events'] += len(term_events)
+        counts['sent_bytes'] += len(encode(term_events))
+        browserscreen.STYLES.trim(screen.linecontainer.styles_in_use)
+
+    start = last_render = time.time()
+    for part in parts:
+        # see Terminal.input and Terminal.run_scheduled
+        stream.feed(part)
+        now = time.time()
+        if now - last_render >= FRAME_INTERVAL:
+            last_render = now
+            render()
+    render()
+    elapsed = time.time() - start
+    events = counts['events']
+    sent_bytes = counts['sent_bytes']
+    return {'bytes_per_sec': len(data) / elapsed,
+            'events_per_sec': events / elapsed,
+            'bytes_per_byte': float(sent_bytes) / len(data)}
+
+def bench_chan_uncontended(n=200000, buflen=64):
+    """Return the put/get pairs/sec on a buffered channel within one thread."""
+    ch = chan.Chan(buflen)
+    start = time.time()
+    for i in xrange(n):
+        ch.put(i)
+        ch.get()
+    return n / (time.time() - start)
+
+def bench_chan_threads(n=100000, buflen=64):
+    """Return the items/sec passed from a producer to a consumer thread."""
+    ch = chan.Chan(buflen)
+    def produce():
+        for i in xrange(n):
+            ch.put(i)
+        ch.close()
+    t = threading.Thread(target=produce)
+    start = time.time()
+    t.start()
+    for _ in ch:
+        pass
+    t.join()
+    return n / (time.time() - start)
+
+def bench_chanselect(n=100000, buflen=64):
+    """Return the items/sec received with chanselect from two busy channels."""
+    a, b = chan.Chan(buflen), chan.Chan(buflen)
+    start = time.time()
+    for i in xrange(n):
+        a.put(i)
+        b.put(i)
+        chan.chanselect([a, b], [])
+        chan.chanselect([a, b], [])
+    return 2 * n / (time.time() - start)
+
+def bench_selector(n=100000, buflen=64):
+    """Like bench_chanselect, using a chan.Selector."""
+    a, b = chan.Chan(buflen), chan.Chan(buflen)
+    selector = chan.Selector([a, b])
+    start = time.time()
+    for i in xrange(n):
+        a.put(i)
+        b.put(i)
+        selector.select()
+        selector.select()
+    elapsed = time.time() - start
+    selector.close()
+    return 2 * n / elapsed
+
+def bench_keypress_latency(forward='forwarder', n=200):
+    """Return the median seconds from a keypress message to its echo.
+
+    The calling thread plays the Qt thread sending websocket
+    messages, a dispatch thread writes the keys to the pty. The pty
+    echoes them as soon as they are written, cat only gets them at
+    the end of a line.
+    """
+    client = terminalio.AsyncResettableTerminal(use_pty=True, cmd='/bin/cat')
+    server_chan = chan.Chan()
+    if forward == 'forwarder':
+        send = utils.Forwarder(server_chan).put
+    else:
+        send = lambda msg: utils.create_thread(lambda: server_chan.put(msg))
+
+    def dispatch():
+        for _, _, data in server_chan:
+            client.write(json.loads(data)['key']['string'].encode('utf-8'))
+    utils.create_thread(dispatch)
+
+    latencies = []
+    for i in xrange(n):
+        start = time.time()
+        send(('websocket_receive', None, json.dumps({'name': 'keypress', 'key': {'string': 'x'}})))
+        while client.out.get() != 'x':
+            pass
+        latencies.append(time.time() - start)
+    client.kill()
+    return sorted(latencies)[n // 2]
+
+CHAN_BENCHMARKS = [
+    ('uncontended', bench_chan_uncontended),
+    ('threads', bench_chan_threads),
+    ('chanselect', bench_chanselect),
+    ('selector', bench_selector),
+]
+
+def in_subprocess(f, *args):
+    """Call f in a forked process, return its result and peak rss growth in KiB.
+
+    Forking keeps the peak memory of each benchmark separate. The
+    forked process starts out with the rss of the parent, only the
+    growth beyond it is reported.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            res = f(*args)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, pickle.dumps((res, peak - baseline)))
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    out = []
+    while True:
+        data = os.read(r, 4096)
+        if not data:
+            break
+        out.append(data)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return pickle.loads(''.join(out))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the schirm terminal emulation.")
+    parser.add_argument("traces", help="Traces to run (%s) or files of recorded pty output, defaults to all traces." % ', '.join(sorted(TRACES)), nargs="*")
+    parser.add_argument("--repeat", help="Run each benchmark this many times, report the best run.", type=int, default=3)
+    parser.add_argument("--chan", help="Run the channel benchmarks instead of the traces.", action="store_true")
+    args = parser.parse_args()
+
+    if args.chan:
+        for name, bench in CHAN_BENCHMARKS:
+            print "chan     %-12s %12.0f ops/sec" % (name, max(bench() for _ in range(args.repeat)))
+        for forward in ('thread', 'forwarder'):
+            res, _ = in_subprocess(bench_keypress_latency, forward)
+            print "keypress %-12s %12.3f ms echo latency" % (forward, res * 1000)
+        return
+
+    unknown = [name for name in args.traces if name not in TRACES and not os.path.isfile(name)]
+    if unknown:
+        parser.error("unknown traces: %s" % ', '.join(sorted(unknown)))
+
+    for name in args.traces or sorted(TRACES):
+        if name in TRACES:
+            data = TRACES[name]()
+        else:
+            with open(name, 'rb') as f:
+                data = f.read()
+            name = os.path.basename(name)
+        for parser in sorted(termscreen.STREAMS):
+            print "stream   %-12s %-8s %12.0f chars/sec" % (parser, name, bench_stream(data, args.repeat, parser))
+        for parser in sorted(termscreen.STREAMS):
+            res, maxrss = in_subprocess(bench_pipeline, data, parser)
+            print "pipeline %-12s %-8s %8.2f MB/s %10.0f events/sec %6.2f json bytes/byte %7.1f MB peak growth" \
+                % (parser, name, res['bytes_per_sec'] / 1e6, res['events_per_sec'], res['bytes_per_byte'], maxrss / 1024.0)
+
+if __name__ == '__main__':
+    main()
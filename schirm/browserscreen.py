@@ -1,8 +1,14 @@
+import bisect
 import itertools
+import collections
 import array
+import json
 
 from pyte.screens import Char
 
+from scrollbackarchive import ScrollbackArchive
+from searchindex import SearchIndex, find_all
+
 DEFAULT_ATTRS = ('default', 'default', False, False, False, False, False)
 
 def char_to_attr(char):
@@ -22,55 +28,624 @@ def char_to_attr(char):
     else:
         return (fg, bg, bold, italics, underscore, strikethrough, False)
 
-_char_attr_class_cache = {}
 def char_attr_to_class(char):
     """Convert cursor attributes into a class attribute string."""
-    cached = _char_attr_class_cache.get(char)
-    if cached:
-        return cached
-    else:
-        fg, bg, bold, italics, underscore, strikethrough, _ = char
-        class_string = ' '.join(('f-%s' % fg,
-                                 'b-%s' % bg,
-                                 'bold' if bold else '',
-                                 'italics' if italics else '',
-                                 'underscore' if underscore else '',
-                                 'strikethrough' if strikethrough else ''))
-        _char_attr_class_cache[char] = class_string
-        return class_string
+    fg, bg, bold, italics, underscore, strikethrough, _ = char
+    return ' '.join(('f-%s' % fg,
+                     'b-%s' % bg,
+                     'bold' if bold else '',
+                     'italics' if italics else '',
+                     'underscore' if underscore else '',
+                     'strikethrough' if strikethrough else ''))
+
+class StyleTable(object):
+    """Intern cursor attributes as small integer style ids.
+
+    Each distinct style is converted into its client attribute tuple
+    and class string once, events carry only the style id.
+
+    trim evicts the least recently interned styles until at most size
+    styles are left, their ids are reused for new styles. Users caching
+    style ids must drop them when evictions changes.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        # style key -> style id, least recently used first
+        self._ids = collections.OrderedDict()
+        # style ids which are never evicted
+        self._pinned = set()
+        # ids of evicted styles
+        self._free = []
+        # style id -> canonical pyte.Char, client attrs and class string
+        self.chars = []
+        self.attrs = []
+        self.classes = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def intern(self, char, pin=False):
+        """Return the style id for the given cursor attributes."""
+        key = char[1:] # the data field is not part of the style
+        ids = self._ids
+        style = ids.pop(key, None)
+        if style is not None:
+            self.hits += 1
+            ids[key] = style
+            return style
+
+        self.misses += 1
+        attr = char_to_attr(char)
+        if self._free:
+            style = self._free.pop()
+            self.chars[style] = char
+            self.attrs[style] = attr
+            self.classes[style] = char_attr_to_class(attr)
+        else:
+            style = len(self.chars)
+            self.chars.append(char)
+            self.attrs.append(attr)
+            self.classes.append(char_attr_to_class(attr))
+        ids[key] = style
+        if pin:
+            self._pinned.add(style)
+        return style
+
+    def trim(self, in_use=None):
+        """Evict the least recently used styles down to size.
+
+        Call this only between frames, when no events refer to
+        style ids any more. in_use is called to get the set of style
+        ids still referred to otherwise (by screen lines), those are
+        kept too.
+        """
+        ids = self._ids
+        if len(ids) <= self.size:
+            return
+        keep = self._pinned
+        if in_use is not None:
+            keep = keep | in_use()
+        pinned = []
+        while len(ids) > self.size:
+            key, style = ids.popitem(last=False)
+            if style in keep:
+                pinned.append((key, style))
+            else:
+                self.evictions += 1
+                self._free.append(style)
+        ids.update(pinned)
+
+STYLES = StyleTable()
+DEFAULT_STYLE = STYLES.intern(Char(data=" ", fg="default", bg="default"), pin=True)
+assert STYLES.attrs[DEFAULT_STYLE] == DEFAULT_ATTRS
+
+class JsonEncoder(object):
+    """Encode compiled events as JSON for the client.
+
+    Replaces the style ids in compiled events, insert events get the
+    client attrs, append-many-lines the class strings. Converts and
+    encodes CHUNK_SIZE events at a time into a reused buffer, instead
+    of converting all events of a frame before encoding them. The
+    output is the same as json.dumps would produce.
+    """
+
+    # number of events encoded with a single json.dumps call
+    CHUNK_SIZE = 256
+
+    def __init__(self):
+        self._out = []
+
+    def encode(self, events):
+        """Return the JSON array of the given compiled events."""
+        out = self._out
+        append = out.append
+        attrs = STYLES.attrs
+        classes = STYLES.classes
+        chunk = []
+        for e in events:
+            cmd = e[0]
+            if cmd == 'insert-overwrite' or cmd == 'insert':
+                _, line, col, string, style = e
+                e = (cmd, line, col, string, attrs[style])
+            elif cmd == 'append-many-lines':
+                e = (cmd, [[(string, classes[style]) for string, style in runs] for runs in e[1]])
+            chunk.append(e)
+            if len(chunk) == self.CHUNK_SIZE:
+                append(json.dumps(chunk)[1:-1])
+                del chunk[:]
+        if chunk:
+            append(json.dumps(chunk)[1:-1])
+        res = '[%s]' % ', '.join(out)
+        del out[:]
+        return res
+
+class StyledLine(object):
+    """A line of text made of runs of styled chars.
+
+    The text is kept as a single string, the runs as two arrays of
+    run end columns and style ids. Overwrite, insert and delete take
+    O(runs), not O(columns).
+
+    >>> l = StyledLine('hello world')
+    >>> l.overwrite(6, 'there', 2)
+    >>> l.insert(0, '> ', 3)
+    >>> l.delete(7, 1)
+    >>> l.overwrite(14, '!', 3)
+    >>> list(l.runs())
+    [('> ', 3), ('hello', 0), ('there', 2), ('  ', 0), ('!', 3)]
+    >>> [list(p.runs()) for p in l.split(6)]
+    [[('> ', 3), ('hell', 0)], [('o', 0), ('there', 2)], [('  ', 0), ('!', 3)]]
+
+    wrapped is set on lines continued on the next line by an
+    automatic wrap.
+    """
+
+    __slots__ = ('text', 'ends', 'styles', 'wrapped')
+
+    # run ends are unsigned shorts
+    MAX_LENGTH = 0xffff
+
+    def __init__(self, text='', style=DEFAULT_STYLE):
+        self.text = text
+        self.ends = array.array('H', [len(text)] if text else [])
+        self.styles = array.array('H', [style] if text else [])
+        self.wrapped = False
+
+    def __len__(self):
+        return len(self.text)
+
+    def runs(self):
+        """Yield a (string, style) tuple for each run."""
+        text = self.text
+        start = 0
+        for end, style in itertools.izip(self.ends, self.styles):
+            yield text[start:end], style
+            start = end
+
+    def extend(self, line):
+        """Append the runs of another line."""
+        for string, style in line.runs():
+            self._append_run(string, style)
+
+    def rstrip(self, style=DEFAULT_STYLE):
+        """Remove trailing spaces in the given style."""
+        while self.styles and self.styles[-1] == style:
+            start = self.ends[-2] if len(self.ends) > 1 else 0
+            stripped = self.text[start:].rstrip(' ')
+            self.text = self.text[:start] + stripped
+            if stripped:
+                self.ends[-1] = len(self.text)
+                break
+            del self.ends[-1]
+            del self.styles[-1]
+
+    def slice(self, start, stop):
+        """Return a new line of the chars from start to stop-1."""
+        res = StyledLine()
+        col = 0
+        for string, style in self.runs():
+            a = max(start - col, 0)
+            b = min(stop - col, len(string))
+            if a < b:
+                res._append_run(string[a:b], style)
+            col += len(string)
+        return res
+
+    def split(self, cols):
+        """Wrap the line into lines of at most cols chars."""
+        res = [self.slice(i, i + cols) for i in xrange(0, len(self.text), cols)] or [StyledLine()]
+        for line in res[:-1]:
+            line.wrapped = True
+        return res
+
+    def _pad(self, col, style):
+        # fill the line up to col
+        n = col - len(self.text)
+        if n > 0:
+            self._append_run(' ' * n, style)
+
+    def _append_run(self, string, style):
+        self.text += string
+        if self.styles and self.styles[-1] == style:
+            self.ends[-1] = len(self.text)
+        else:
+            self.ends.append(len(self.text))
+            self.styles.append(style)
+
+    def _split(self, col):
+        """Ensure a run starts at col, return the index of that run."""
+        ends = self.ends
+        i = bisect.bisect_right(ends, col)
+        if i < len(ends) and (ends[i-1] if i else 0) != col:
+            # col is inside run i
+            ends.insert(i, col)
+            self.styles.insert(i, self.styles[i])
+            i += 1
+        return i
+
+    def _join(self, i):
+        """Merge run i into run i-1 when both have the same style."""
+        if 0 < i < len(self.styles) and self.styles[i-1] == self.styles[i]:
+            del self.ends[i-1]
+            del self.styles[i]
+
+    def overwrite(self, col, string, style, fill=DEFAULT_STYLE):
+        """Replace the chars from col on with string.
+
+        Pad the line with spaces in the fill style when col is beyond
+        its end.
+        """
+        if not string:
+            return
+        self._pad(col, fill)
+        end = col + len(string)
+        if col == len(self.text):
+            self._append_run(string, style)
+            return
+        i = self._split(col)
+        j = self._split(min(end, len(self.text)))
+        self.ends[i:j] = array.array('H', [end])
+        self.styles[i:j] = array.array('H', [style])
+        self.text = self.text[:col] + string + self.text[end:]
+        self._join(i+1)
+        self._join(i)
+
+    def insert(self, col, string, style, fill=DEFAULT_STYLE):
+        """Insert string at col, moving the following chars right."""
+        if not string:
+            return
+        self._pad(col, fill)
+        if col == len(self.text):
+            self._append_run(string, style)
+            return
+        n = len(string)
+        i = self._split(col)
+        ends = self.ends
+        for k in xrange(i, len(ends)):
+            ends[k] += n
+        ends.insert(i, col + n)
+        self.styles.insert(i, style)
+        self.text = self.text[:col] + string + self.text[col:]
+        self._join(i+1)
+        self._join(i)
+
+    def delete(self, col, n):
+        """Remove n chars starting at col, moving the following chars left."""
+        end = min(col + n, len(self.text))
+        if col >= end:
+            return
+        i = self._split(col)
+        j = self._split(end)
+        del self.ends[i:j]
+        del self.styles[i:j]
+        ends = self.ends
+        n = end - col
+        for k in xrange(i, len(ends)):
+            ends[k] -= n
+        self.text = self.text[:col] + self.text[end:]
+        self._join(i)
+
+class Scrollback(object):
+    """Lines scrolled off the top of the screen.
+
+    Keeps the last size lines, numbered by their position in the
+    history of all lines ever scrolled off: lines start to end-1 are
+    available. Lines are stored as a UTF-8 string and a packed array
+    of run ends and style numbers. Style numbers are local to the
+    scrollback as the ids in STYLES are reused after evictions.
+
+    Lines dropped from the start go to the archive, a
+    ScrollbackArchive, when there is one. Its lines are numbered like
+    the scrollback lines.
+
+    The lines held in memory are indexed for search, lazily when
+    searching, to keep push cheap.
+
+    A scrollback of size 0 without an archive only counts the lines.
+
+    >>> sb = Scrollback(size=2)
+    >>> for text in ('one', 'two', 'three'):
+    ...     sb.push(StyledLine(text))
+    >>> sb.start, sb.end
+    (1, 3)
+    >>> sb.pop()
+    >>> sb.search('w', 5)
+    [(1, 1)]
+    """
+
+    def __init__(self, size=100000, archive=None):
+        self.size = size
+        self.archive = archive
+        self.index = SearchIndex()
+        # lines before this one have been indexed
+        self._indexed = 0
+        self._lines = collections.deque()
+        # number of the oldest line held in memory
+        self.start = 0
+        # style key -> scrollback style number, and its pyte.Char
+        self._style_numbers = {}
+        self._chars = []
+
+    def __len__(self):
+        return len(self._lines)
+
+    @property
+    def end(self):
+        return self.start + len(self._lines)
+
+    def _style_number(self, style):
+        char = STYLES.chars[style]
+        key = char[1:]
+        n = self._style_numbers.get(key)
+        if n is None:
+            n = self._style_numbers[key] = len(self._chars)
+            self._chars.append(char)
+        return n
+
+    def _pack(self, line):
+        text = line.text
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        runs = array.array('H')
+        for end, style in itertools.izip(line.ends, line.styles):
+            runs.append(end)
+            runs.append(self._style_number(style))
+        return text, runs.tostring()
+
+    def push(self, line):
+        """Add a StyledLine to the end of the scrollback.
+
+        Move the line dropped from its start to stay within size to
+        the archive.
+        """
+        if not self.size and self.archive is None:
+            self.start += 1
+            return
+        self._lines.append(self._pack(line))
+        if len(self._lines) > self.size:
+            self.start += 1
+            dropped = self._lines.popleft()
+            if self.archive is not None:
+                self.archive.append(dropped)
+
+    def pop(self):
+        """Remove the last line held in memory, if any."""
+        if self._lines:
+            self._lines.pop()
+            self._indexed = min(self._indexed, self.end)
+        elif self.start and not self.size and self.archive is None:
+            # lines are only counted
+            self.start -= 1
+
+    def _texts(self, start, stop):
+        """Return the text of the lines start to stop-1 held in memory."""
+        lines = self._lines
+        return [lines[i][0].decode('utf-8') for i in xrange(start - self.start, stop - self.start)]
+
+    def _update_index(self):
+        """Index the lines pushed since the last search."""
+        start = max(self._indexed, self.start)
+        for n, text in enumerate(self._texts(start, self.end), start):
+            self.index.add(n, text)
+        self._indexed = self.end
+        self.index.discard(self.start)
+
+    # number of archived lines read at once by search
+    ARCHIVE_SEARCH_LINES = 4096
+
+    def search(self, query, limit):
+        """Return the (line, col) positions of query in the scrollback.
+
+        Return the last limit matches, in ascending order. The lines
+        held in memory are looked up in the index, archived lines
+        are scanned when there are less than limit matches in memory.
+
+        >>> sb = Scrollback()
+        >>> for text in ('make', 'foo.c:1: error', 'foo.c:2: Error'):
+        ...     sb.push(StyledLine(text))
+        >>> sb.search('error', 10)
+        [(1, 9), (2, 9)]
+        >>> sb = Scrollback(size=1, archive=ScrollbackArchive(2**20))
+        >>> for text in ('error 1', 'warning', 'error 2'):
+        ...     sb.push(StyledLine(text))
+        >>> sb.search('error', 10)
+        [(0, 0), (2, 0)]
+        """
+        self._update_index()
+        blocks = self.index.blocks(query)
+        if blocks is None:
+            ranges = [(self.start, self.end)]
+        else:
+            n = self.index.BLOCK_LINES
+            ranges = [(max(b * n, self.start), min((b + 1) * n, self.end)) for b in blocks]
+        res = []
+        for start, stop in reversed(ranges):
+            if self._find(res, start, self._texts(start, stop), query, limit):
+                return res[::-1]
+        archive = self.archive
+        if archive is not None:
+            stop = min(self.start, archive.end)
+            while stop > archive.start:
+                start = max(stop - self.ARCHIVE_SEARCH_LINES, archive.start)
+                texts = [text.decode('utf-8') for text, _ in archive.get(start, stop)]
+                # most chunks do not contain the query at all
+                if query.lower() in u'\n'.join(texts).lower():
+                    if self._find(res, start, texts, query, limit):
+                        break
+                stop = start
+        return res[::-1]
+
+    @staticmethod
+    def _find(res, start, texts, query, limit):
+        """Append the matches in texts, the lines from start on, last first to res.
+
+        Return True once res holds limit matches.
+        """
+        for i in xrange(len(texts) - 1, -1, -1):
+            for col in reversed(find_all(texts[i], query)):
+                res.append((start + i, col))
+                if len(res) >= limit:
+                    return True
+        return False
+
+class _IframeLine(StyledLine):
+    """The line an iframe is displayed in."""
+    __slots__ = ()
 
 def compact_insert_overwrites(insert_events, cols):
     """Reduce the number of insert-overwrite operations for a single line.
 
     Take a group of (possibly overlapping) insert-overwrites (on the
-    same line) and return a list of (string, class-string) tuples.
+    same line) and return a list of (string, style) tuples.
     """
     assert insert_events
 
-    line_chars = [' '] * cols
-    line_attrs = [DEFAULT_ATTRS] * cols
-
-    # build
-    for name, line, col, string, attr in insert_events:
+    line = StyledLine(' ' * cols)
+    for name, _, col, string, style in insert_events:
         assert name == 'insert-overwrite'
-        end = col+len(string)
-        line_chars[col:end] = string
-        line_attrs[col:end] = [attr]*len(string)
+        line.overwrite(col, string, style)
+
+    return list(line.runs())
+
+# style of the columns of a line not written by an insert-overwrite,
+# see merge_insert_overwrites
+_UNWRITTEN = 0xffff
+
+def merge_insert_overwrites(writes):
+    """Merge insert-overwrite events on a single line.
+
+    Return one insert-overwrite for each run of written chars with the
+    same style, in column order.
+
+    >>> merge_insert_overwrites([('insert-overwrite', 0, 2, 'abc', 1),
+    ...                          ('insert-overwrite', 0, 3, 'X', 1),
+    ...                          ('insert-overwrite', 0, 7, 'de', 2)])
+    [('insert-overwrite', 0, 2, 'aXc', 1), ('insert-overwrite', 0, 7, 'de', 2)]
+    """
+    if len(writes) == 1:
+        return writes
+
+    line = StyledLine()
+    for _, _, col, string, style in writes:
+        line.overwrite(col, string, style, fill=_UNWRITTEN)
 
-    # partition
     res = []
-    prev_i = None
-    prev_a = None
-    for i,a in enumerate(line_attrs):
-        if a != prev_a:
-            if prev_a is not None:
-                res.append((''.join(line_chars[prev_i:i]), char_attr_to_class(prev_a)))
-            prev_i = i
-            prev_a = a
-    res.append((''.join(line_chars[prev_i:i]), char_attr_to_class(a)))
+    lineno = writes[0][1]
+    col = 0
+    for string, style in line.runs():
+        if style != _UNWRITTEN:
+            res.append(('insert-overwrite', lineno, col, string, style))
+        col += len(string)
+    return res
+
+# events that modify a single line in place
+_LINE_WRITES = frozenset(['insert-overwrite', 'insert', 'remove'])
 
+def _drop_dead_events(events):
+    """Drop writes to lines removed later and all but the last cursor.
+
+    Walk the events backwards, tracking which lines will be removed by
+    a following remove-line. Events that move lines in ways other than
+    insert-line or remove-line end the tracking.
+    """
+    res = []
+    dead = set() # line numbers at the current event
+    cursor_seen = False
+    for e in reversed(events):
+        cmd = e[0]
+        if cmd in _LINE_WRITES:
+            if e[1] in dead:
+                continue
+        elif cmd == 'cursor':
+            if cursor_seen:
+                continue
+            cursor_seen = True
+        elif cmd == 'remove-line':
+            y = e[1]
+            dead = set(d+1 if d >= y else d for d in dead)
+            dead.add(y)
+        elif cmd == 'insert-line':
+            y = e[1]
+            dead = set(d-1 if d > y else d for d in dead if d != y)
+        elif cmd in ('enter-alt-mode', 'leave-alt-mode'):
+            # cursor events before address the other screen
+            dead = set()
+            cursor_seen = False
+        elif cmd not in ('adjust', 'set-title'):
+            dead = set()
+        res.append(e)
+    res.reverse()
     return res
 
+def optimize_events(events):
+    """Remove and merge redundant events of a single frame.
+
+    - merge overlapping insert-overwrites on each line
+    - drop writes to lines that are removed later in the same frame
+    - cancel an insert-line directly followed by a remove-line of the
+      same line
+    - keep only the last of consecutive set-line-origin events and
+      only the last cursor event
+
+    >>> optimize_events([('insert-overwrite', 1, 0, 'foo', 0),
+    ...                  ('cursor', 1, 3),
+    ...                  ('insert-line', 3),
+    ...                  ('insert-overwrite', 3, 0, 'bar', 0),
+    ...                  ('remove-line', 3),
+    ...                  ('insert-overwrite', 1, 1, 'X', 0),
+    ...                  ('set-line-origin', 10),
+    ...                  ('set-line-origin', 11),
+    ...                  ('cursor', 2, 0)])
+    [('insert-overwrite', 1, 0, 'fXo', 0), ('set-line-origin', 11), ('cursor', 2, 0)]
+
+    Writes to removed lines follow the lines moved by other
+    insert-line and remove-line events:
+
+    >>> optimize_events([('insert-overwrite', 5, 0, 'foo', 0),
+    ...                  ('insert-overwrite', 6, 0, 'bar', 0),
+    ...                  ('insert-line', 2),
+    ...                  ('remove-line', 0),
+    ...                  ('remove-line', 5)])
+    [('insert-overwrite', 6, 0, 'bar', 0), ('insert-line', 2), ('remove-line', 0), ('remove-line', 5)]
+    """
+    res = []
+    writes = {} # line -> insert-overwrites of the current run of writes
+    writes_before_insert = {}
+    for e in _drop_dead_events(events):
+        cmd = e[0]
+        if cmd == 'insert-overwrite':
+            line_writes = writes.get(e[1])
+            if line_writes is None:
+                writes[e[1]] = line_writes = []
+                # placeholder for the merged writes of this line
+                res.append(line_writes)
+            line_writes.append(e)
+            continue
+
+        prev = res[-1] if res else None
+        if cmd == 'remove-line' and prev == ('insert-line', e[1]):
+            res.pop()
+            # as if neither had happened, continue the previous run
+            writes = writes_before_insert
+            continue
+
+        if cmd == 'insert-line':
+            writes_before_insert = writes
+        writes = {}
+        if cmd == 'set-line-origin' and prev and prev[0] == 'set-line-origin':
+            res[-1] = e
+        else:
+            res.append(e)
+
+    compiled = []
+    for e in res:
+        if isinstance(e, list):
+            compiled.extend(merge_insert_overwrites(e))
+        else:
+            compiled.append(e)
+    return compiled
+
 def compile_appends(events, max_lines=256):
     """Merge append-lines and insert-overwrites into a single operation.
 
@@ -144,7 +719,7 @@ class BrowserScreen(object):
     # expensive and eating more memory.
     SCROLLBACK_SIZE = 4000 # conservative setting
 
-    def __init__(self):
+    def __init__(self, scrollback_size=0, archive_size=0):
         self._events = []
         # the number of rendered lines on the screen and in the scrollback
         # we need to keep track of this on the server to be able to
@@ -152,8 +727,7 @@ class BrowserScreen(object):
         self.total_lines = 0
         # offset splitting the line buffer in a scrollback and screen part
         self.line_origin = 0
-        # current width, required for the compile step to determine
-        # text inserts into appended lines
+        # current width, lines are cut off at this column, see insert
         self.cols = 0
 
         # Save total lines and origin when switching to alt-mode.
@@ -163,13 +737,32 @@ class BrowserScreen(object):
         self._saved_total_lines = 0
         self._alt_mode = False
 
+        # Visible lines written since the last line structure change,
+        # see insert_overwrite. Maps line numbers to the list of their
+        # insert-overwrite events.
+        self._grid = {}
+
+        # The lines visible on the client, from the line origin on,
+        # and the lines above it the client still keeps, to pull them
+        # back onto a growing screen. The server side scrollback keeps
+        # scrollback_size lines for search, none by default. With an
+        # archive_size (in bytes), lines dropped from the scrollback
+        # are archived on disk.
+        self._screen = []
+        self._saved_screen = []
+        self._above = collections.deque(maxlen=self.SCROLLBACK_SIZE + self.SCROLLBACK_CLEANUP_THRESHOLD)
+        self.scrollback = Scrollback(scrollback_size, ScrollbackArchive(archive_size) if archive_size else None)
+        # client screen height, required to pad lines like append-line does
+        self._height = 0
+
     def _compile(self, events):
         events.append(('adjust',))
-        return compile_appends(events)
+        return compile_appends(optimize_events(events))
 
     ### consuming events
 
     def pop_events(self):
+        self._flush_grid()
         e = self._events
         self._events = []
         return self._compile(e)
@@ -177,8 +770,74 @@ class BrowserScreen(object):
     ### tools
 
     def _append(self, ev):
+        # any event besides insert-overwrite may change the line
+        # structure or depend on the line contents
+        self._flush_grid()
         self._events.append(ev)
 
+    def _flush_line(self, line):
+        """Emit the final contents of the overwrites of a grid line."""
+        writes = merge_insert_overwrites(self._grid.pop(line))
+        self._events.extend(writes)
+        l = self._line(line)
+        for _, _, col, string, style in writes:
+            l.overwrite(col, string, style)
+
+    def _flush_grid(self):
+        if self._grid:
+            for line in sorted(self._grid):
+                self._flush_line(line)
+
+    def _line(self, y):
+        """Return the StyledLine at y, adding missing lines like the client."""
+        screen = self._screen
+        while len(screen) <= y:
+            screen.append(StyledLine())
+        return screen[y]
+
+    def _move_origin(self, delta):
+        """Move lines between the screen and the scrollback."""
+        screen = self._screen
+        if delta > 0:
+            if not self._alt_mode:
+                # the client adds missing lines above the origin too
+                for i in xrange(delta):
+                    line = screen[i] if i < len(screen) else StyledLine()
+                    self._above.append(line)
+                    self.scrollback.push(line)
+            del screen[:delta]
+        elif delta < 0 and not self._alt_mode:
+            lines = []
+            for _ in xrange(-delta):
+                self.scrollback.pop()
+                lines.append(self._above.pop() if self._above else StyledLine())
+            lines.reverse()
+            screen[:0] = lines
+
+    def search(self, query, limit=1000):
+        """Return the last limit (line, col) positions of query.
+
+        Lines are numbered like the scrollback lines, the lines of
+        the (main) screen follow the scrollback.
+        """
+        screen = self._saved_screen if self._alt_mode else self._screen
+        res = []
+        for y in xrange(len(screen) - 1, -1, -1):
+            for col in reversed(find_all(screen[y].text, query)):
+                res.append((self.scrollback.end + y, col))
+        res = res[:limit]
+        res.reverse()
+        if len(res) < limit:
+            res[:0] = self.scrollback.search(query, limit - len(res))
+        return res
+
+    def styles_in_use(self):
+        """Return the set of style ids of the client lines, see StyleTable.trim."""
+        res = set()
+        for line in itertools.chain(self._screen, self._saved_screen, self._above):
+            res.update(line.styles)
+        return res
+
     def _update_total_lines(self, current_line):
         """Track how many real lines are on the display.
 
@@ -196,40 +855,85 @@ class BrowserScreen(object):
     #     x (col, pos)
     #     y (line)
     #   string - a string to insert/replace
-    #   attr - tuple of the attributes defined in schirm-cljs.screen.CharacterStyle
-
-    def insert(self, line, col, string, attr):
-        """Insert string in line at col using the given attributes."""
+    #   style - a style id from STYLES, sent to the client as a
+    #           tuple of the attributes defined in schirm-cljs.screen.CharacterStyle
+
+    def insert(self, line, col, string, style):
+        """Insert string in line at col using the given style.
+
+        Chars moved beyond the last column are dropped, like a
+        terminal does.
+
+        >>> screen = BrowserScreen()
+        >>> screen.reset(1, 10)
+        >>> screen.insert_overwrite(0, 0, 'hello', DEFAULT_STYLE)
+        >>> screen.insert(0, 2, ' ' * 9999, DEFAULT_STYLE)
+        >>> screen._line(0).text
+        'he        '
+        >>> screen.pop_events()[-3:]
+        [('insert', 0, 2, '        ', 0), ('remove', 0, 10, 3), ('adjust',)]
+        """
         self._update_total_lines(line)
-        self._append(('insert', line, col, string, char_to_attr(attr)))
-
-    def insert_overwrite(self, line, col, string, attr):
-        """Insert string in line starting at col overwriting existing chars."""
+        if line in self._grid:
+            self._flush_line(line)
+        string = string[:max(0, self.cols - col)]
+        self._events.append(('insert', line, col, string, style))
+        l = self._line(line)
+        l.insert(col, string, style)
+        overflow = len(l) - self.cols
+        if overflow > 0:
+            self._events.append(('remove', line, self.cols, overflow))
+            l.delete(self.cols, overflow)
+
+    def insert_overwrite(self, line, col, string, style):
+        """Insert string in line starting at col overwriting existing chars.
+
+        Only record the overwrite in the grid, all overwrites of a
+        line are emitted as its final contents when the grid is
+        flushed. Chars beyond the last column are dropped.
+        """
         self._update_total_lines(line)
-        self._append(('insert-overwrite', line, col, string, char_to_attr(attr)))
+        string = string[:max(0, self.cols - col)]
+        ev = ('insert-overwrite', line, col, string, style)
+        writes = self._grid.get(line)
+        if writes is None:
+            self._grid[line] = [ev]
+        else:
+            writes.append(ev)
 
     def remove(self, line, col, n):
         """Delete n characters from line starting at col."""
         self._update_total_lines(line)
-        self._append(('remove', line, col, n))
+        if line in self._grid:
+            self._flush_line(line)
+        self._events.append(('remove', line, col, n))
+        self._line(line).delete(col, n)
 
-    def insert_line(self, y, attrs=None):
+    def insert_line(self, y, style=None):
         """Insert a new line at y."""
-        # TODO: attrs ????
-        #       and why do only some line inserts use 'attrs'?
+        # TODO: style ????
+        #       and why do only some line inserts use 'style'?
         self._update_total_lines(y)
         self._append(('insert-line', y))
+        if y:
+            self._line(y - 1)
+        self._screen.insert(y, StyledLine())
 
     def append_line(self, columns):
         """Append a new line (increments the origin)."""
         self.total_lines += 1
         self._append(('append-line', columns, self.total_lines - self.line_origin - 1))
+        if self._height > 1:
+            self._line(self._height - 2)
+        self._screen.append(StyledLine())
         self.add_line_origin(1) # total lines do not change as we increase the origin
 
     def remove_line(self, y):
         """remove the line at index y."""
         self._update_total_lines(y)
         self._append(('remove-line', y))
+        if y < len(self._screen):
+            del self._screen[y]
 
     def cursor(self, line, col):
         self._append(('cursor', line, col))
@@ -241,22 +945,29 @@ class BrowserScreen(object):
     #       when a resize happens, compile a previous events to
     #       determine the current state of the screen
     def set_line_origin(self, line_origin):
-        self.line_origin = max(0, min(self.total_lines, line_origin))
-        self._append(('set-line-origin', self.line_origin))
+        line_origin = max(0, min(self.total_lines, line_origin))
+        self._append(('set-line-origin', line_origin))
+        self._move_origin(line_origin - self.line_origin)
+        self.line_origin = line_origin
 
     def add_line_origin(self, delta):
         self.set_line_origin(self.line_origin + delta)
 
-    def reset(self, lines):
+    def reset(self, lines, columns):
         """Reset the browser screen."""
         assert not self._events
         self.total_lines = 0
         self._append(('reset', lines))
+        self._screen = []
+        self._height = lines
+        self.cols = columns
 
     def resize(self, old_lines, new_lines, new_columns):
         """Resize the browserscreen from old_lines to new_lines height."""
         assert not self._events # events must have been flushed before
 
+        self._height = new_lines
+        self.cols = new_columns
         line_delta = new_lines - old_lines
         remaining_empty_lines = old_lines - (self.total_lines - self.line_origin) - 1
 
@@ -290,6 +1001,95 @@ class BrowserScreen(object):
 
         return delta # used to compute the new cursor pos
 
+    def set_wrapped(self, line, wrapped=True):
+        """Mark line as continued on the next line by an automatic wrap."""
+        if wrapped or line < len(self._screen):
+            self._line(line).wrapped = wrapped
+
+    def reflow(self, old_columns, columns, y, x):
+        """Rewrap the screen lines from old_columns to columns.
+
+        Join lines continued by automatic wraps and wrap them again,
+        replacing the lines on the client. Lines pushed off the top
+        of the screen move to the scrollback. Return the new cursor
+        position for the cursor at y, x, or None if the lines were
+        not reflowed.
+
+        The scrollback is not reflowed, neither is the alt screen, a
+        screen showing iframes or a screen with wrapped lines longer
+        than StyledLine.MAX_LENGTH when joined.
+        """
+        screen = self._screen
+        if (self._alt_mode or columns == old_columns
+            or any(isinstance(line, _IframeLine) for line in screen)):
+            return None
+        length = 0
+        for line in screen:
+            if line.wrapped:
+                length += old_columns
+            else:
+                length += len(line)
+            if length > StyledLine.MAX_LENGTH:
+                return None
+            if not line.wrapped:
+                length = 0
+        self._flush_grid()
+
+        # join wrapped lines, find the cursor offset within its line
+        lines = []
+        joined = None
+        cursor = None
+        for i, line in enumerate(screen):
+            if joined is None:
+                joined = StyledLine()
+            if i == y:
+                cursor = len(lines), len(joined) + x
+            joined.extend(line)
+            if line.wrapped:
+                joined._pad(len(joined) + old_columns - len(line), DEFAULT_STYLE)
+            else:
+                lines.append(joined)
+                joined = None
+        if joined is not None:
+            lines.append(joined)
+        if cursor is None:
+            cursor = len(lines) + y - len(screen), x
+
+        rows = []
+        for i, line in enumerate(lines):
+            if i == cursor[0]:
+                cursor_row = len(rows)
+            line.rstrip()
+            rows.extend(line.split(columns))
+        if cursor[0] >= len(lines):
+            cursor_row = len(rows) + cursor[0] - len(lines)
+        row, x = divmod(cursor[1], columns)
+        if row and not x and cursor[1] >= old_columns:
+            # keep a pending wrap at the end of the line
+            row, x = row - 1, columns
+        cursor_row += row
+
+        # keep the cursor on the screen, the rows above it are moved
+        # to the scrollback
+        while len(rows) > cursor_row + 1 and not rows[-1].text:
+            rows.pop()
+        overflow = max(0, cursor_row - (self._height - 1))
+        del rows[overflow + self._height:]
+
+        # replace the client lines
+        for _ in screen:
+            self._events.append(('remove-line', 0))
+        for i, line in enumerate(rows):
+            col = 0
+            for string, style in line.runs():
+                self._events.append(('insert-overwrite', i, col, string, style))
+                col += len(string)
+        self._screen = rows
+        self.total_lines = self.line_origin + len(rows)
+        if overflow:
+            self.add_line_origin(overflow)
+        return cursor_row - overflow, x
+
     def reverse_all_lines(self):
         TODO
 
@@ -300,8 +1100,10 @@ class BrowserScreen(object):
             self._alt_mode = True
             self._saved_total_lines = self.total_lines
             self._saved_line_origin = self.line_origin
+            self._saved_screen = self._screen
             self.total_lines = 0
             self.line_origin = 0
+            self._screen = []
 
         self._append(('enter-alt-mode',))
 
@@ -312,6 +1114,8 @@ class BrowserScreen(object):
             self._alt_mode = False
             self.total_lines = self._saved_total_lines
             self.line_origin = self._saved_line_origin
+            self._screen = self._saved_screen
+            self._saved_screen = []
 
         self._append(('leave-alt-mode',))
 
@@ -323,9 +1127,11 @@ class BrowserScreen(object):
         surplus_lines = self.total_lines - self.SCROLLBACK_SIZE
         if surplus_lines > self.SCROLLBACK_CLEANUP_THRESHOLD:
             # remove them
+            # the lines stay in the scrollback
             self._append(('scrollback-cleanup', surplus_lines))
             self.total_lines -= surplus_lines
-            self.add_line_origin(-surplus_lines)
+            self.line_origin = max(0, self.line_origin - surplus_lines)
+            self._append(('set-line-origin', self.line_origin))
 
     def set_title(self, string):
         self._append(('set-title', string))
@@ -335,6 +1141,8 @@ class BrowserScreen(object):
     def iframe_enter(self, iframe_id, line):
         self._update_total_lines(line)
         self._append(('iframe-enter', iframe_id, line))
+        self._line(line)
+        self._screen[line] = _IframeLine()
         if self._alt_mode:
             self._append(('iframe-resize', iframe_id, 'fullscreen'))
 
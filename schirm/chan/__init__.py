@@ -1,5 +1,5 @@
 from .chan import Error, ChanClosed, Timeout
-from .chan import Chan, chanselect
+from .chan import Chan, chanselect, Selector
 from .chan import quickthread
 
 __version__ = '0.3.0'
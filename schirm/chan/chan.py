@@ -43,6 +43,13 @@ class Full(Exception):
     pass
 
 
+def _size(value):
+    """The size of a value for the max_bytes limits."""
+    if isinstance(value, basestring):
+        return len(value)
+    return 0
+
+
 class WishGroup(object):
     def __init__(self):
         self.fulfilled_by = None
@@ -92,41 +99,48 @@ class Wish(object):
 
 
 class RingBuffer(object):
-    def __init__(self, buflen):
-        self.buf = [None] * buflen
-        self.next_pop = 0
-        self._len = 0
+    """A buffer of at most buflen values.
+
+    With max_bytes, the buffer is also full once the length of the
+    string values in it reaches max_bytes.
+    """
+    def __init__(self, buflen, max_bytes=None):
+        self.buf = collections.deque()
+        self.buflen = buflen
+        self.max_bytes = max_bytes
+        # size of the buffered values, tracked only with max_bytes
+        self.bytes = 0
 
     @property
     def cap(self):
-        return len(self.buf)
+        return self.buflen
 
     def push(self, value):
-        if self._len == len(self.buf):
+        if self.full:
             raise IndexError()
-        next_push = (self.next_pop + self._len) % len(self.buf)
-        self.buf[next_push] = value
-        self._len += 1
+        self.buf.append(value)
+        if self.max_bytes is not None:
+            self.bytes += _size(value)
 
     def pop(self):
-        if self._len == 0:
+        if not self.buf:
             raise IndexError()
-        value = self.buf[self.next_pop]
-        self.buf[self.next_pop] = None  # Safety
-        self.next_pop = (self.next_pop + 1) % len(self.buf)
-        self._len -= 1
+        value = self.buf.popleft()
+        if self.max_bytes is not None:
+            self.bytes -= _size(value)
         return value
 
     def __len__(self):
-        return self._len
+        return len(self.buf)
 
     @property
     def empty(self):
-        return self._len == 0
+        return not self.buf
 
     @property
     def full(self):
-        return self._len == len(self.buf)
+        return (len(self.buf) == self.buflen
+                or (self.max_bytes is not None and self.bytes >= self.max_bytes))
 
 
 class Chan(object):
@@ -138,19 +152,33 @@ class Chan(object):
                    already waiting, while a buffered channel will accept puts
                    without blocking as long as the buffer is not full.
 
+    :param max_bytes: Optionally limits the buffer of a buffered channel by
+                      the length of the strings in it too.  Once the
+                      buffered strings reach ``max_bytes``, puts block until
+                      items are taken again.  The last string put may exceed
+                      the limit.
+
     """
-    def __init__(self, buflen=0):
+    def __init__(self, buflen=0, max_bytes=None):
         self._lock = threading.Lock()
         self._closed = False
 
         if buflen > 0:
-            self._buf = RingBuffer(buflen)
+            self._buf = RingBuffer(buflen, max_bytes)
+            # the buffered items, for the fast paths in get and put
+            self._items = self._buf.buf
         else:
             self._buf = None
+            self._items = None
+        self._buflen = buflen
+        self._max_bytes = max_bytes
+
+        self._waiting_producers = collections.deque()
+        self._waiting_consumers = collections.deque()
 
-        # TODO: Lists are inefficient lifo queues
-        self._waiting_producers = []
-        self._waiting_consumers = []
+        # Selectors consuming from this channel, notified when it
+        # becomes ready
+        self._selectors = []
 
     def __repr__(self):
         return "<Chan 0x%x>" % id(self)
@@ -166,7 +194,7 @@ class Chan(object):
         def fulfill_waiting_producer():
             while True:
                 if self._waiting_producers:
-                    produce_wish = self._waiting_producers.pop(0)
+                    produce_wish = self._waiting_producers.popleft()
                     with produce_wish.group.lock:
                         if not produce_wish.group.fulfilled:
                             return produce_wish.fulfill()
@@ -175,16 +203,24 @@ class Chan(object):
 
         if self._buf is not None and not self._buf.empty:
             value = self._buf.pop()
-            try:
-                # Cycles a producer's value onto the buffer
-                produced = fulfill_waiting_producer()
-                self._buf.push(produced)
-            except Empty:
-                pass
+            # Cycles producers' values onto the buffer while it has room
+            while not self._buf.full:
+                try:
+                    self._buf.push(fulfill_waiting_producer())
+                except Empty:
+                    break
             return value
         else:
             return fulfill_waiting_producer()
 
+    def _notify_selectors(self):
+        """Wake up the selectors of this channel.
+
+        Must be called with the Chan unlocked.
+        """
+        for selector in self._selectors:
+            selector._notify()
+
     def _put_nowait(self, value):
         """
         Gives value to a waiting consumer, or raises Full
@@ -193,7 +229,7 @@ class Chan(object):
         """
         while True:
             if self._waiting_consumers:
-                consume_wish = self._waiting_consumers.pop(0)
+                consume_wish = self._waiting_consumers.popleft()
                 with consume_wish.group.lock:
                     if not consume_wish.group.fulfilled:
                         consume_wish.fulfill(value)
@@ -220,6 +256,19 @@ class Chan(object):
                  buffer is empty, and no threads are waiting on ``put``.
 
         """
+        # Fast path: take a buffered item when no producer waits for
+        # room, without setting up a wish.
+        lock = self._lock
+        lock.acquire()
+        items = self._items
+        if items and not self._waiting_producers:
+            value = items.popleft()
+            if self._max_bytes is not None:
+                self._buf.bytes -= _size(value)
+            lock.release()
+            return value
+        lock.release()
+
         if timeout is not None:
             timeout_deadline = time.time() + timeout
 
@@ -257,6 +306,33 @@ class Chan(object):
             raise ChanClosed(which=self)
         return wish.value
 
+    def _get_more(self, values, max_items, max_bytes):
+        """Append available values to values until a limit is reached.
+
+        Assumes that the Chan is locked.
+        """
+        size = sum(_size(v) for v in values)
+        while ((max_items is None or len(values) < max_items)
+               and (max_bytes is None or size < max_bytes)):
+            try:
+                value = self._get_nowait()
+            except Empty:
+                break
+            values.append(value)
+            size += _size(value)
+        return values
+
+    def get_available(self, max_items=None, max_bytes=None):
+        """Returns a list of the items available without blocking.
+
+        Takes at most ``max_items`` items.  Stops taking items once
+        ``max_bytes`` is reached by the length of the string items, so
+        the last item may exceed it.  The list may be empty.
+
+        """
+        with self._lock:
+            return self._get_more([], max_items, max_bytes)
+
     def put(self, value, timeout=None):
         """Places an item onto the channel.
 
@@ -277,6 +353,23 @@ class Chan(object):
         :raises: :class:`ChanClosed` If the channel has already been closed.
 
         """
+        # Fast path: buffer the item when there is room and no
+        # consumer is waiting, without setting up a wish.
+        lock = self._lock
+        lock.acquire()
+        items = self._items
+        if (items is not None and len(items) < self._buflen
+            and (self._max_bytes is None or self._buf.bytes < self._max_bytes)
+            and not self._waiting_consumers and not self._closed):
+            items.append(value)
+            if self._max_bytes is not None:
+                self._buf.bytes += _size(value)
+            lock.release()
+            if self._selectors:
+                self._notify_selectors()
+            return
+        lock.release()
+
         if timeout is not None:
             timeout_deadline = time.time() + timeout
 
@@ -285,17 +378,23 @@ class Chan(object):
                 raise ChanClosed(which=self)
             try:
                 self._put_nowait(value)
-                return
+                put = True
             except Full:
-                pass
+                put = False
 
             # Shortcut for if the operation shouldn't block.
-            if timeout is not None and timeout <= 0:
+            if not put and timeout is not None and timeout <= 0:
                 raise Timeout()
 
-            group = WishGroup()
-            wish = Wish(group, WISH_PRODUCE, self, value)
-            self._waiting_producers.append(wish)
+            if not put:
+                group = WishGroup()
+                wish = Wish(group, WISH_PRODUCE, self, value)
+                self._waiting_producers.append(wish)
+
+        # a selector may take the value now
+        self._notify_selectors()
+        if put:
+            return
 
         with group.lock:
             while not group.fulfilled:
@@ -326,13 +425,15 @@ class Chan(object):
             self._closed = True
 
             # Copies waiting wishes, to be fulfilled when the Chan is unlocked.
-            wishes = self._waiting_producers[:] + self._waiting_consumers[:]
+            wishes = list(self._waiting_producers) + list(self._waiting_consumers)
 
         for wish in wishes:
             with wish.group.lock:
                 if not wish.fulfilled:
                     wish.fulfill(closed=True)
 
+        self._notify_selectors()
+
     @property
     def closed(self):
         """Returns True if the channel is closed.
@@ -426,21 +527,30 @@ def chanselect(consumers, producers, timeout=None):
             else:  # PRODUCE
                 try:
                     wish.chan._put_nowait(wish.value)
-                    return wish.chan, None
+                    produced = wish.chan
+                    break
                 except Full:
                     pass
+        else:
+            produced = None
 
-        # If chanselect shouldn't block, then we can exit here, and shortcut
-        # adding wishes to other channels.
-        if timeout is not None and timeout <= 0:
-            raise Timeout()
+            # If chanselect shouldn't block, then we can exit here, and shortcut
+            # adding wishes to other channels.
+            if timeout is not None and timeout <= 0:
+                raise Timeout()
 
-        # Enqueues wishes, to wait for fulfillment
-        for wish in group.wishes:
-            if wish.kind == WISH_CONSUME:
-                wish.chan._waiting_consumers.append(wish)
-            else:
-                wish.chan._waiting_producers.append(wish)
+            # Enqueues wishes, to wait for fulfillment
+            for wish in group.wishes:
+                if wish.kind == WISH_CONSUME:
+                    wish.chan._waiting_consumers.append(wish)
+                else:
+                    wish.chan._waiting_producers.append(wish)
+
+    # selectors may take the values offered now
+    for chan, value in producers:
+        chan._notify_selectors()
+    if produced is not None:
+        return produced, None
 
     # Waits for the wish to be fulfilled
     with group.lock:
@@ -478,6 +588,96 @@ def chanselect(consumers, producers, timeout=None):
     return wish.chan, wish.value
 
 
+class Selector(object):
+    """Consume from whichever of a fixed set of channels is ready first.
+
+    Like ``chanselect(consumers, [])`` for repeated use: the channels
+    are registered once and wake up the selector when they get ready,
+    instead of setting up wishes on every call. Ready channels are
+    served round-robin.
+
+    .. code-block:: python
+
+        selector = Selector([chan_a, chan_b])
+        try:
+            while True:
+                ch, value = selector.select()
+                ...
+        finally:
+            selector.close()
+
+    Values are taken from channels only in ``select``, a thread
+    blocked in ``get`` on one of the channels is served first.
+    """
+    def __init__(self, consumers):
+        self._chans = list(consumers)
+        # index of the channel to look at first
+        self._next = 0
+        self._cond = threading.Condition(threading.Lock())
+        # set by the channels when they may have become ready
+        self._pending = False
+        for chan in self._chans:
+            with chan._lock:
+                chan._selectors.append(self)
+
+    def _notify(self):
+        with self._cond:
+            self._pending = True
+            self._cond.notify()
+
+    def _get_nowait(self, chan):
+        """Return a value of chan, raise Empty or ChanClosed."""
+        with chan._lock:
+            try:
+                return chan._get_nowait()
+            except Empty:
+                if chan._closed:
+                    raise ChanClosed(which=chan)
+                raise
+
+    def select(self, timeout=None):
+        """Return (:class:`Chan`, value) of the next ready channel.
+
+        Raises :class:`ChanClosed` for a closed channel once its
+        buffer is empty, :class:`Timeout` if no channel gets ready
+        within timeout seconds.
+        """
+        if timeout is not None:
+            timeout_deadline = time.time() + timeout
+
+        chans = self._chans
+        n = len(chans)
+        while True:
+            with self._cond:
+                self._pending = False
+
+            for k in xrange(n):
+                i = (self._next + k) % n
+                try:
+                    value = self._get_nowait(chans[i])
+                except Empty:
+                    continue
+                self._next = i + 1
+                return chans[i], value
+
+            with self._cond:
+                while not self._pending:
+                    if timeout is None:
+                        self._cond.wait()
+                    else:
+                        remaining = timeout_deadline - time.time()
+                        if remaining <= 0:
+                            raise Timeout()
+                        self._cond.wait(remaining)
+
+    def close(self):
+        """Unregister from the channels."""
+        for chan in self._chans:
+            with chan._lock:
+                chan._selectors.remove(self)
+        self._chans = []
+
+
 def quickthread(fn, *args, **kwargs):
     name = kwargs.pop('__name', None)
     th = threading.Thread(
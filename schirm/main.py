@@ -12,10 +12,23 @@ import webkitwindow
 
 import terminal
 import terminalio
+import termscreen
 import utils
 
 logger = logging.getLogger('schirm')
 
+# most bytes of terminal output taken from the client at once
+OUTPUT_BATCH_BYTES = 256 * 1024
+
+def join_output(values):
+    """Join consecutive strings of terminal output."""
+    for is_string, group in itertools.groupby(values, lambda v: isinstance(v, basestring)):
+        if is_string:
+            yield ''.join(group)
+        else:
+            for v in group:
+                yield v
+
 def init_logger(level=logging.ERROR, filters=[]):
     l = logging.getLogger('schirm')
     h = logging.StreamHandler()
@@ -40,6 +53,8 @@ class SchirmHandler(object):
     def __init__(self, dest_chan, startup_fn):
         self._dest_chan = dest_chan
         self._startup_fn = startup_fn
+        # keeps the Qt thread from blocking on dest_chan
+        self._forwarder = utils.Forwarder(dest_chan, name='schirm-forwarder')
 
     def startup(self, window):
         signal.signal(signal.SIGINT, signal.SIG_DFL) # exit on CTRL-C
@@ -60,17 +75,17 @@ class SchirmHandler(object):
     def request(self, req):
         # non blocking
         req.id = self._ids.next()
-        utils.create_thread(lambda: self._dest_chan.put(('request', req)))
+        self._forwarder.put(('request', req))
 
     def connect(self, websocket):
         # non blocking
-        utils.create_thread(lambda: self._dest_chan.put(('websocket_connect', websocket)))
+        self._forwarder.put(('websocket_connect', websocket))
         # websocket.connected()
 
     def receive(self, websocket, data):
         # print "Websocket recv", websocket, data
         # websocket.send('my'+data) # echo
-        utils.create_thread(lambda: self._dest_chan.put(('websocket_receive', websocket, data)))
+        self._forwarder.put(('websocket_receive', websocket, data))
 
     def close(self, websocket):
         print "Websocket closed", websocket
@@ -82,7 +97,10 @@ def setup_and_dispatch(server_chan,
                        cmd,
                        start_clojurescript_repl=False,
                        initial_request=None,
-                       window_control=None):
+                       window_control=None,
+                       parser='statemachine',
+                       scrollback=0,
+                       scrollback_archive=0):
 
     # client process (pty or plain process)
     client = terminalio.AsyncResettableTerminal(
@@ -94,52 +112,69 @@ def setup_and_dispatch(server_chan,
     term = terminal.Terminal(client,
                              url=terminal_url,
                              start_clojurescript_repl=start_clojurescript_repl,
-                             window_control=window_control)
+                             window_control=window_control,
+                             parser=parser,
+                             scrollback=scrollback,
+                             scrollback_archive=scrollback_archive)
 
     if initial_request:
         term.request(initial_request)
 
-    channels = [client.out, server_chan]
-
-    while True:
-        res = True
+    # registered once, served round-robin
+    selector = chan.Selector([client.out, server_chan])
+    try:
+        while True:
+            res = True
+
+            try:
+                # wake up to render frames and resizes scheduled by the terminal
+                ch, val = selector.select(timeout=term.timeout())
+                closed = False
+            except chan.ChanClosed, co:
+                ch = co.which
+                val = None
+                closed = True
+            except chan.Timeout:
+                term.run_scheduled()
+                continue
+
+            if ch == client.out:
+                assert not closed
+
+                # output from the terminal process, all pending
+                # output is parsed at once and rendered once
+                vals = [val] + client.out.get_available(max_bytes=OUTPUT_BATCH_BYTES)
+                for val in join_output(vals):
+                    res = term.input(val)
+                    if res is False:
+                        break
+
+            elif ch == server_chan:
+                assert not closed
+                msgtype = val[0]
+                if msgtype == 'request':
+                    res = term.request(val[1])
+                elif msgtype == 'websocket_connect':
+                    res = term.websocket_connect(val[1])
+                elif msgtype == 'websocket_receive':
+                    res = term.websocket_receive(val[1], val[2])
+                else:
+                    assert 'unknown msgtype: %r' % (msgtype, )
 
-        try:
-            ch, val = chan.chanselect(consumers=channels, producers=[])
-            closed = False
-        except chan.ChanClosed, co:
-            ch = co.which
-            val = None
-            closed = True
-
-        if ch == client.out:
-            assert not closed
-
-            # output from the terminal process
-            res = term.input(val)
-
-        elif ch == server_chan:
-            assert not closed
-            msgtype = val[0]
-            if msgtype == 'request':
-                res = term.request(val[1])
-            elif msgtype == 'websocket_connect':
-                res = term.websocket_connect(val[1])
-            elif msgtype == 'websocket_receive':
-                res = term.websocket_receive(val[1], val[2])
             else:
-                assert 'unknown msgtype: %r' % (msgtype, )
+                assert False
 
-        else:
-            assert False
+            term.run_scheduled()
 
-        # deal with the returnvalue
-        if res == 'reload':
-            return 'reload', val[1] # the initial request
-        elif res is False:
-            return False, None
+            # deal with the returnvalue
+            if res == 'reload':
+                return 'reload', val[1] # the initial request
+            elif res is False:
+                return False, None
+    finally:
+        selector.close()
 
-def run(use_pty=True, cmd=None, start_clojurescript_repl=False):
+def run(use_pty=True, cmd=None, start_clojurescript_repl=False, parser='statemachine', scrollback=0, scrollback_archive=0):
 
     # pyqt embedded webkit
     server_chan = chan.Chan()
@@ -155,7 +190,10 @@ def run(use_pty=True, cmd=None, start_clojurescript_repl=False):
                                           terminal_url=terminal_url,
                                           start_clojurescript_repl=start_clojurescript_repl,
                                           initial_request=req,
-                                          window_control=window_control)
+                                          window_control=window_control,
+                                          parser=parser,
+                                          scrollback=scrollback,
+                                          scrollback_archive=scrollback_archive)
             if res == 'reload':
                 pass
             else:
@@ -178,6 +216,9 @@ def main():
     parser.add_argument("--command", help="The command to execute within the terminal instead of the current users default shell.")
     parser.add_argument("--rpdb", help="Start the Remote Python debugger using this password.")
     parser.add_argument("--repl", "--start-clojurescript-repl", help="Start Clojurescript REPL to debug the Schirm client code.", action="store_true")
+    parser.add_argument("--parser", help="The escape sequence parser to use, 'regex' matches whole sequences at once.", choices=sorted(termscreen.STREAMS), default='statemachine')
+    parser.add_argument("--scrollback", help="The number of lines kept in the server side scrollback for search, none by default.", type=int, default=0)
+    parser.add_argument("--scrollback-archive", help="Keep lines dropped from the scrollback in an on disk archive of up to this many MiB.", type=int, default=0)
     args = parser.parse_args()
 
     if args.rpdb:
@@ -200,7 +241,10 @@ def main():
 
     run(use_pty=not args.no_pty,
         cmd=args.command or None,
-        start_clojurescript_repl=args.repl)
+        start_clojurescript_repl=args.repl,
+        parser=args.parser,
+        scrollback=args.scrollback,
+        scrollback_archive=args.scrollback_archive * 2**20)
 
 if __name__ == '__main__':
     main()
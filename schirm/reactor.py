@@ -0,0 +1,169 @@
+import os
+import errno
+import fcntl
+import heapq
+import select
+import time
+import logging
+import itertools
+import threading
+import collections
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class Reactor(object):
+    """A single thread multiplexing the file descriptors of all terminals.
+
+    Handlers registered with register are called with the ready file
+    descriptor and the epoll event mask. Functions passed to call or
+    call_later run in the reactor thread too, so handlers and calls
+    never run concurrently and do not need any locking among
+    themselves.
+
+    Handlers must not block as they would stall every other terminal.
+    """
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._handlers = {}
+        # fds which are registered but not watched for any events
+        self._paused = set()
+
+        # functions to call from within the reactor thread
+        self._calls = collections.deque()
+
+        # heap of (deadline, seq, fn) tuples, see call_later
+        self._timers = []
+        self._timer_seq = itertools.count()
+
+        # wake up the epoll loop when a call is scheduled from
+        # another thread
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        set_nonblocking(self._wakeup_read)
+        set_nonblocking(self._wakeup_write)
+        self._epoll.register(self._wakeup_read, select.EPOLLIN)
+
+        self._thread = None
+
+    def start(self):
+        self._thread = utils.create_thread(self._run, name='reactor')
+
+    # file descriptors
+
+    def register(self, fd, handler, events=select.EPOLLIN):
+        """Call handler(fd, events) whenever fd is ready for events."""
+        self._handlers[fd] = handler
+        self._epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        """Change the events fd is watched for, 0 to pause it.
+
+        Paused fds are removed from the epoll set as epoll reports
+        hangups and errors even for an empty event mask.
+        """
+        if not events:
+            if fd not in self._paused:
+                self._paused.add(fd)
+                self._epoll.unregister(fd)
+        elif fd in self._paused:
+            self._paused.discard(fd)
+            self._epoll.register(fd, events)
+        else:
+            self._epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            if fd in self._paused:
+                self._paused.discard(fd)
+                return
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, OSError), e:
+                # fd has already been closed
+                pass
+
+    # calls
+
+    def call(self, fn):
+        """Call fn in the reactor thread, in order of submission.
+
+        Safe to use from any thread.
+        """
+        self._calls.append(fn)
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            # pipe is full, the reactor is going to wake up anyway
+
+    def call_later(self, delay, fn):
+        """Call fn in the reactor thread after delay seconds.
+
+        Must be used from within the reactor thread.
+        """
+        heapq.heappush(self._timers, (time.time() + delay, next(self._timer_seq), fn))
+
+    def _call_safely(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Error in reactor call %r", fn)
+
+    def _poll_timeout(self):
+        if self._calls:
+            return 0
+        elif self._timers:
+            return max(0, self._timers[0][0] - time.time())
+        else:
+            return -1
+
+    def _run(self):
+        while True:
+            try:
+                events = self._epoll.poll(self._poll_timeout())
+            except (IOError, OSError), e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, mask in events:
+                if fd == self._wakeup_read:
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except OSError, e:
+                        pass
+                else:
+                    handler = self._handlers.get(fd)
+                    if handler:
+                        self._call_safely(handler, fd, mask)
+
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, fn = heapq.heappop(self._timers)
+                self._call_safely(fn)
+
+            # only run the calls which have been scheduled until now,
+            # calls scheduling other calls are handled in the next
+            # iteration
+            for _ in range(len(self._calls)):
+                self._call_safely(self._calls.popleft())
+
+_reactor = None
+_reactor_lock = threading.Lock()
+
+def get_reactor():
+    """Return the reactor shared by all terminals, starting it if necessary."""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = Reactor()
+            _reactor.start()
+        return _reactor
@@ -0,0 +1,129 @@
+"""Append-only on disk archive of scrollback lines.
+
+Lines dropped from the in-memory browserscreen.Scrollback end up
+here. The archive is made of segments, each a data file of line
+records and an index file of their offsets:
+
+  data  - per line a 4 byte text length and a 4 byte runs length
+          (both unsigned big-endian) followed by the UTF-8 text and
+          the packed runs
+  index - per line the 8 byte unsigned big-endian offset of its
+          record in the data file
+
+Both are read through mmap, so fetching any line takes one index and
+one data lookup. When a segment exceeds its share of the size limit a
+new one is started, the oldest segment is deleted once there are more
+than SEGMENTS of them.
+
+Segments are anonymous temporary files, they go away with the
+terminal.
+"""
+
+import mmap
+import struct
+import tempfile
+import collections
+
+_header = struct.Struct('>II')
+_offset = struct.Struct('>Q')
+
+class _Segment(object):
+
+    def __init__(self, first, directory=None):
+        # number of the first line in this segment
+        self.first = first
+        self.lines = 0
+        self.size = 0
+        self._data = tempfile.TemporaryFile(prefix='schirm-scrollback-', dir=directory)
+        self._index = tempfile.TemporaryFile(prefix='schirm-scrollback-', dir=directory)
+        # maps of the files and the number of lines they cover
+        self._data_map = None
+        self._index_map = None
+        self._mapped_lines = 0
+
+    def append(self, text, runs):
+        self._index.write(_offset.pack(self.size))
+        self._data.write(_header.pack(len(text), len(runs)))
+        self._data.write(text)
+        self._data.write(runs)
+        self.size += _header.size + len(text) + len(runs)
+        self.lines += 1
+
+    def _unmap(self):
+        if self._data_map is not None:
+            self._data_map.close()
+            self._index_map.close()
+            self._data_map = self._index_map = None
+            self._mapped_lines = 0
+
+    def _map(self):
+        """Map the files again when lines have been appended."""
+        if self._mapped_lines != self.lines:
+            self._unmap()
+            self._data.flush()
+            self._index.flush()
+            self._data_map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index_map = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_lines = self.lines
+
+    def get(self, start, stop):
+        """Yield the (text, runs) records of lines start to stop-1 of this segment."""
+        if start >= stop:
+            return
+        self._map()
+        data = self._data_map
+        index = self._index_map
+        for i in xrange(start - self.first, stop - self.first):
+            offset, = _offset.unpack_from(index, i * _offset.size)
+            text_len, runs_len = _header.unpack_from(data, offset)
+            offset += _header.size
+            yield data[offset:offset+text_len], data[offset+text_len:offset+text_len+runs_len]
+
+    def close(self):
+        self._unmap()
+        self._data.close()
+        self._index.close()
+
+class ScrollbackArchive(object):
+    """Keep packed scrollback lines on disk, using at most size bytes.
+
+    Lines are numbered in the order they were appended, lines start
+    to end-1 are available.
+    """
+
+    SEGMENTS = 4
+
+    def __init__(self, size, directory=None):
+        self.size = size
+        self.directory = directory
+        self._segments = collections.deque()
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, entry):
+        """Append a (text, runs) line record as packed by the Scrollback."""
+        segments = self._segments
+        if not segments or segments[-1].size >= self.size // self.SEGMENTS:
+            segments.append(_Segment(self.end, self.directory))
+            if len(segments) > self.SEGMENTS:
+                old = segments.popleft()
+                self.start += old.lines
+                old.close()
+        segments[-1].append(*entry)
+        self.end += 1
+
+    def get(self, start, stop):
+        """Return the records of the available lines from start to stop-1."""
+        res = []
+        for segment in self._segments:
+            res.extend(segment.get(max(start, segment.first),
+                                   min(stop, segment.first + segment.lines)))
+        return res
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments.clear()
@@ -0,0 +1,108 @@
+"""Trigram index for searching the scrollback.
+
+Lines are grouped in blocks of BLOCK_LINES lines. The index maps each
+lowercase trigram to the ascending numbers of the blocks containing
+it, a search only needs to look at the lines of the blocks containing
+all trigrams of the query.
+"""
+
+import array
+import bisect
+
+def find_all(text, query):
+    """Return the columns of the case-insensitive occurrences of query in text.
+
+    >>> find_all('a.b.A.', 'a.')
+    [0, 4]
+    """
+    text = text.lower()
+    query = query.lower()
+    res = []
+    col = text.find(query)
+    while col != -1:
+        res.append(col)
+        col = text.find(query, col + len(query))
+    return res
+
+class SearchIndex(object):
+    """Incrementally index lines numbered in ascending order.
+
+    >>> index = SearchIndex()
+    >>> for n, text in enumerate(['make all', 'gcc -c foo.c', 'Error: foo.c:1']):
+    ...     index.add(n, text)
+    >>> index.blocks('foo.c')
+    [0]
+    >>> index.blocks('bar')
+    []
+    >>> index.blocks('c') is None
+    True
+    """
+
+    BLOCK_LINES = 32
+
+    def __init__(self):
+        # trigram -> array of block numbers
+        self._postings = {}
+        # first block still indexed
+        self.start_block = 0
+        # block up to which the postings have been pruned
+        self._pruned_block = 0
+        self._last_block = 0
+
+    @staticmethod
+    def _trigrams(text):
+        grams = set([text[i:i+3] for i in xrange(len(text) - 2)])
+        # too common to be useful
+        grams.discard('   ')
+        return grams
+
+    def add(self, n, text):
+        """Index the text of line n."""
+        block = n // self.BLOCK_LINES
+        self._last_block = block
+        postings = self._postings
+        for g in self._trigrams(text.lower()):
+            p = postings.get(g)
+            if p is None:
+                postings[g] = array.array('i', [block])
+            elif p[-1] != block:
+                p.append(block)
+
+    def discard(self, start):
+        """Stop finding lines before start.
+
+        Removes the dropped blocks from the postings once there are
+        more dropped than indexed ones.
+        """
+        self.start_block = start // self.BLOCK_LINES
+        if self.start_block - self._pruned_block > self._last_block - self.start_block:
+            for g, p in self._postings.items():
+                i = bisect.bisect_left(p, self.start_block)
+                if i == len(p):
+                    del self._postings[g]
+                elif i:
+                    del p[:i]
+            self._pruned_block = self.start_block
+
+    def blocks(self, query):
+        """Return the ascending numbers of the blocks which may contain query.
+
+        Return None when the query has no trigrams to look up, all
+        blocks may contain it then.
+        """
+        grams = self._trigrams(query.lower())
+        if not grams:
+            return None
+        postings = []
+        for g in grams:
+            p = self._postings.get(g)
+            if p is None:
+                return []
+            postings.append(p)
+        postings.sort(key=len)
+        blocks = set(postings[0])
+        for p in postings[1:]:
+            blocks.intersection_update(p)
+            if not blocks:
+                return []
+        return sorted(b for b in blocks if b >= self.start_block)
@@ -13,6 +13,7 @@ import chan
 import webkitwindow
 
 import utils
+from termscreen import IFRAME_SCRIPT
 
 logger = logging.getLogger(__name__)
 
@@ -25,11 +26,6 @@ def get_iframe_id(req_or_ws):
     m = re.match("(?P<iframe_id>.+)\.localhost", req_or_ws.url_netloc)
     return m.group('iframe_id') if m else None
 
-# <script> tags injected into iframes to provide interoperability
-# between the frame and the surrounding terminal (resizing, key
-# handlers, communication-websocket, ...)
-IFRAME_SCRIPT = ('<script type="text/javascript" src="schirm.js"></script>'
-                 '<script type="text/javascript">schirm.initFrame()</script>')
 
 def instrument_html(html_string):
     """Inject schirm frame init code as <script> into an HTML string.
@@ -100,10 +96,11 @@ def instrument_html(html_string):
 
 class Iframes(object):
 
-    def __init__(self, client):
+    def __init__(self, write):
         self.iframes = {}
         self.iframe_websocket_chans = {} # map websocket chans to iframe objects
-        self.client = client
+        # writes to the terminal process, queued behind pending keyboard input
+        self.write = write
 
     def request(self, req):
 
@@ -159,7 +156,7 @@ class Iframes(object):
         if name == 'iframe-enter':
             # create a new iframe, switch terminal into 'iframe_document_mode'
             logger.debug("iframe-enter %r", event)
-            self.iframes[iframe_id] = Iframe(iframe_id, self.client)
+            self.iframes[iframe_id] = Iframe(iframe_id, self.write)
             return [event]
         elif name == 'iframe-resize':
             return [event]
@@ -190,7 +187,7 @@ class Iframe(object):
         '/schirm.css': "schirm.css", # schirm iframe mode styles
     }
 
-    def __init__(self, iframe_id, client):
+    def __init__(self, iframe_id, write):
         self.id = iframe_id
         self.resources = {}
         self.requests = {} # map of requests, waiting for responses from the client
@@ -204,7 +201,7 @@ class Iframe(object):
         self._websocket = None # schirm -> iframe websocket
         self.pending_commands = [] # enqueue commands made by the client before establishing the websocket connection with the iframe
 
-        self.client = client
+        self.write = write
 
         # uri to send commands from the iframe to the emulator (via POST), e.g. resize
         self.comm_path = '/schirm'
@@ -226,7 +223,7 @@ class Iframe(object):
 
     def _command_respond(self, response_data):
         # todo:
-        # self.client.write("ESC codes"+response_data)
+        # self.write("ESC codes"+response_data)
         pass
 
     # iframe terminal methods
@@ -483,6 +480,9 @@ class Iframe(object):
                 # write the response wrapped as an ECMA-48 string back
                 # to the terminal and keep the req around, waiting for
                 # a response from the terminal
+                # While the terminal process is congested, the request
+                # waits in the write queue behind any earlier input and
+                # is written once the client has drained.
 
                 req_path = req.url_path
                 if req.url_query:
@@ -502,7 +502,7 @@ class Iframe(object):
                                     STR_END,
                                     # trailing newline required for flushing
                                     NEWLINE])
-                self.client.write(term_req)
+                self.write(term_req)
                 self.requests[req.id] = req
 
             else:
@@ -529,7 +529,7 @@ class Iframe(object):
     def websocket(self, ch, val):
         # ???????????????????????????????????????
         if ch == self.recv_chan:
-            self.client.write(''.join((START_MSG,
+            self.write(''.join((START_MSG,
                                        base64.b64encode(req.data['val']),
                                        END, NEWLINE)))
         else:
@@ -7,12 +7,14 @@ import logging
 import socket
 import subprocess
 import time
+import collections
 
 import pyte
 import utils
 import termkey
 import termscreen
 import termiframe
+import browserscreen
 import proxyconnection
 
 logger = logging.getLogger(__name__)
@@ -41,9 +43,42 @@ class Terminal(object):
         """Return a non-guessable localhost subdomain url for this terminal."""
         return "http://%s.localhost" % (id or utils.roll_id())
 
-    def __init__(self, client, size=(80,25), url=None, start_clojurescript_repl=False, window_control=None):
+    # seconds between two rendered frames, output arriving within
+    # a frame is rendered at once at the start of the next one
+    FRAME_INTERVAL = 0.016
+
+    # large writes (pastes) are split into chunks of this size to
+    # be able to pause between them when the client is congested
+    WRITE_CHUNK_SIZE = 4096
+
+    # seconds the size requested by the client has to stay the same
+    # before the terminal is resized, dragging a window edge sends
+    # a new size for each step
+    RESIZE_DELAY = 0.1
+
+    # most matches sent for a single search request
+    SEARCH_LIMIT = 1000
+
+    def __init__(self, client, size=(80,25), url=None, start_clojurescript_repl=False, window_control=None, parser='statemachine', scrollback=0, scrollback_archive=0):
         self.client = client
         self.size = size
+        # number of lines kept in the server side scrollback and
+        # the size in bytes of its on disk archive (0 to disable)
+        self.scrollback = scrollback
+        self.scrollback_archive = scrollback_archive
+        # name of the escape sequence parser, see termscreen.STREAMS
+        self.parser = parser
+
+        # writes waiting for the client to drain, see write
+        self._pending_writes = collections.deque()
+
+        # render scheduling, see schedule_render
+        self._render_due = None
+        self._last_render = 0
+
+        # resize scheduling, see resize
+        self._resize_due = None
+        self._pending_size = None
         self._start_clojurescript_repl = start_clojurescript_repl
 
         # SchirmHandler._WindowControl, to have access to
@@ -57,13 +92,15 @@ class Terminal(object):
 
     def reset(self):
         # set up the terminal emulation:
-        self.screen = termscreen.TermScreen(*self.size)
-        self.stream = termscreen.SchirmStream()
+        self.screen = termscreen.TermScreen(*self.size, scrollback_size=self.scrollback,
+                                            archive_size=self.scrollback_archive)
+        self.stream = termscreen.STREAMS[self.parser]()
         self.stream.attach(self.screen)
-        self.iframes = termiframe.Iframes(self.client)
+        self.iframes = termiframe.Iframes(self.write)
 
         # terminal websocket
         self.websocket = None
+        self.json_encoder = browserscreen.JsonEncoder()
         self.state = None # None -> 'ready' -> 'closed'
 
         if self._start_clojurescript_repl:
@@ -71,6 +108,20 @@ class Terminal(object):
 
     # helpers
 
+    def write(self, data):
+        """Write data to the client, obeying its backpressure.
+
+        Hold back data while the client is congested, keeping it in
+        order with any writes that are already waiting.
+        """
+        for i in range(0, len(data), self.WRITE_CHUNK_SIZE):
+            self._pending_writes.append(data[i:i+self.WRITE_CHUNK_SIZE])
+        self._write_pending()
+
+    def _write_pending(self):
+        while self._pending_writes and self.client.writable():
+            self.client.write(self._pending_writes.popleft())
+
     def send_js(self, js):
         if isinstance(src, basestring):
             js = [src]
@@ -140,7 +191,7 @@ class Terminal(object):
         elif key == 'control-z':
             key = {u'control': True, u'code': 90, u'name': u'Z', u'shift': False, u'alt': False, u'string': u''}
         keycode = self.decode_keypress(key)
-        self.client.write(keycode)
+        self.write(keycode)
 
     def resize(self, cols, lines):
         # enforce sensible bounds
@@ -150,10 +201,17 @@ class Terminal(object):
         # gnome-terminal).
         w = min(2**14, max(11, int(cols)))
         h = min(2**14, max(1, int(lines)))
-        # The client will put a special 'resize' message on its
-        # output channel after the receive happened.
-        # Once we receive this, we will resize the client too.
-        self.client.set_size(h, w)
+        # Wait until the size settles, see run_scheduled.
+        self._pending_size = (h, w)
+        self._resize_due = time.time() + self.RESIZE_DELAY
+
+    def _resize_if_due(self):
+        if self._resize_due is not None and self._resize_due <= time.time():
+            self._resize_due = None
+            # The client will put a special 'resize' message on its
+            # output channel after the receive happened.
+            # Once we receive this, we will resize the client too.
+            self.client.set_size(*self._pending_size)
 
     def paste_selection(self, string=None):
         """Unless None, write the given string to the client.
@@ -164,11 +222,36 @@ class Terminal(object):
         if string is None:
             s = utils.get_xselection()
             if s:
-                self.client.write(s)
+                self.write(s)
         else:
-            self.client.write(string)
+            self.write(string)
+
+    def schedule_render(self):
+        """Render at the start of the next frame.
+
+        Renders immediately if the last frame is older than
+        FRAME_INTERVAL, so interactive use is not delayed. While
+        output is streaming in, all of it is rendered once per frame.
+        """
+        if self._render_due is None:
+            self._render_due = max(time.time(), self._last_render + self.FRAME_INTERVAL)
+
+    def timeout(self):
+        """Return the seconds until the next scheduled render or resize or None."""
+        due = [t for t in (self._render_due, self._resize_due) if t is not None]
+        if not due:
+            return None
+        return max(0, min(due) - time.time())
+
+    def run_scheduled(self):
+        """Resize and render when due."""
+        self._resize_if_due()
+        if self._render_due is not None and self._render_due <= time.time():
+            self.render()
 
     def render(self, msg=None):
+        self._render_due = None
+        self._last_render = time.time()
 
         # text-cursor TODO: turn that into an EVENT to toggle the cursor display
         # if not self.screen.cursor.hidden and not self.screen.iframe_mode:
@@ -189,19 +272,41 @@ class Terminal(object):
         if not events:
             return
 
-        # dispatch iframe-* events
-        term_events = []
+        self._send_events(self._dispatch_iframe_events(events))
+
+        # all pending events have been sent, only the screen lines
+        # refer to style ids now
+        browserscreen.STYLES.trim(self.screen.linecontainer.styles_in_use)
+
+    def _send_events(self, events):
+        self.websocket.send(self.json_encoder.encode(events))
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Search the scrollback and screen for query, ignoring case.
+
+        Send the client a search-results event with the query and the
+        [line, col] positions of the last limit matches. Lines are
+        numbered from the first line that ever scrolled off the
+        screen, the screen lines follow the scrollback.
+
+        The term.js client does not send search messages yet, there
+        is no search box to type a query into.
+        """
+        if self.state != 'ready' or not query:
+            return
+        matches = self.screen.linecontainer.search(query, min(int(limit), self.SEARCH_LIMIT))
+        self._send_events([('search-results', query, matches)])
+
+    def _dispatch_iframe_events(self, events):
+        """Yield the render events, dispatching iframe-* events to self.iframes."""
         for e in events:
             if e[0].startswith("iframe-"):
                 res = self.iframes.dispatch(e)
                 if res:
-                    term_events.extend(res)
+                    for r in res:
+                        yield r
             else:
-                term_events.append(e)
-
-        self.websocket.send(json.dumps(term_events))
-
-        return
+                yield e
 
     # handlers
 
@@ -289,11 +394,13 @@ class Terminal(object):
         # input or resize events from the terminal process
         if isinstance(data, basestring):
             self.stream.feed(data)
-            self.render()
+            self.schedule_render()
             return True
         elif isinstance(data, tuple) and data[0] == 'resize':
             self.screen.resize(lines=data[1], columns=data[2])
-            self.render()
+            self.schedule_render()
+        elif isinstance(data, tuple) and data[0] == 'write-drained':
+            self._write_pending()
         elif data is None:
             return False # quit
         else:
@@ -301,7 +408,7 @@ class Terminal(object):
 
     def iframe_resize(self, iframe_id, height):
         self.screen.iframe_resize(iframe_id, height)
-        self.render()
+        self.schedule_render()
 
     def iframe_request_close(self):
         """Request leaving iframe mode by sending SIGINT (CTRL-C).
@@ -327,6 +434,7 @@ class Terminal(object):
 
     valid_msg_names = set(['keypress',
                            'resize',
+                           'search',
                            'paste_selection',
                            'iframe_resize',
                            'iframe_request_close',
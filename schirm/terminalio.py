@@ -1,4 +1,5 @@
 import os
+import io
 import pwd
 import struct
 import fcntl
@@ -7,9 +8,13 @@ import signal
 import subprocess
 import logging
 import select
+import time
+import errno
+import threading
+import collections
 
 import chan
-import utils
+from reactor import get_reactor, set_nonblocking
 
 def _debug(s):
     print "IO:", repr(s.replace("\x1b[", '<CSI>').replace("\x1b", '<ESC>'))
@@ -30,11 +35,125 @@ def create_terminal(size=(80,25), use_pty=True, cmd=None):
     else:
         return SubprocessTerminal(cmd, size, env)
 
-class PseudoTerminal(object):
+class ReadStats(object):
+    """Throughput counters for a terminal reader.
+
+    A frame is a single call to read that returned data, it may
+    consist of several os-level reads.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.bytes = 0
+        self.reads = 0
+        self.frames = 0
+
+    def add_frame(self, nbytes, nreads):
+        self.bytes += nbytes
+        self.reads += nreads
+        self.frames += 1
+
+    @property
+    def bytes_per_sec(self):
+        elapsed = time.time() - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def reads_per_frame(self):
+        return float(self.reads) / self.frames if self.frames else 0.0
+
+    def __repr__(self):
+        return "<ReadStats %d bytes, %.0f bytes/sec, %.2f reads/frame>" % (
+            self.bytes, self.bytes_per_sec, self.reads_per_frame)
+
+class QueuedWriter(object):
+    """Write to a non-blocking file descriptor, queueing what it does not accept.
+
+    Subclasses call _init_writer with the file descriptor.
+    """
+
+    def _init_writer(self, fd):
+        self._write_fd = fd
+        # strings waiting to be written, the first one may already be
+        # written partially up to _write_offset
+        self._write_queue = collections.deque()
+        self._write_offset = 0
+        self.write_queue_size = 0
+        # never block on writes, see flush
+        set_nonblocking(fd)
+
+    def write_fileno(self):
+        return self._write_fd
+
+    def write(self, data):
+        """Write data to the file descriptor without blocking.
+
+        Data can be a string or a list of strings. Whatever is not
+        accepted immediately is queued, call flush when the file
+        descriptor is writable again.
+
+        Return the number of bytes still queued.
+        """
+        if isinstance(data, basestring):
+            data = [data]
+        for x in data:
+            if isinstance(x, unicode):
+                x = x.encode('utf-8')
+            if x:
+                self._write_queue.append(x)
+                self.write_queue_size += len(x)
+        return self.flush()
+
+    def flush(self):
+        """Write as much queued data as possible without blocking.
+
+        Return the number of bytes still queued.
+        """
+        try:
+            while self._write_queue:
+                chunk = self._write_queue[0]
+                n = os.write(self._write_fd, memoryview(chunk)[self._write_offset:])
+                self.write_queue_size -= n
+                self._write_offset += n
+                if self._write_offset < len(chunk):
+                    # short write, the buffer is full
+                    break
+                self._write_queue.popleft()
+                self._write_offset = 0
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                # the reader is gone, drop any pending data
+                self._write_failed()
+                self._write_queue.clear()
+                self._write_offset = 0
+                self.write_queue_size = 0
+        return self.write_queue_size
+
+    def _write_failed(self):
+        pass
+
+class PseudoTerminal(QueuedWriter):
+
+    # adaptive read size: start with the linux pty buffer size and
+    # double it each time a read fills the requested size completely
+    MIN_READ_SIZE = 4096
+    MAX_READ_SIZE = 1024 * 1024
 
     def __init__(self, cmd, size, env):
         self.size = size
 
+        # reusable read buffer, see _read_available
+        self._read_size = self.MIN_READ_SIZE
+        self._buffer = bytearray(self.MAX_READ_SIZE)
+        self._buffer_view = memoryview(self._buffer)
+        self.stats = ReadStats()
+        # set when the last read found the pty delivering data
+        # faster than it was read
+        self.lagging = False
+
         # args
         if isinstance(cmd, basestring):
             cmd = cmd.split()
@@ -56,6 +175,8 @@ class PseudoTerminal(object):
             self.pid = pid
             self.master = master
             self.state = 'running'
+            self._reader = io.FileIO(master, 'r', closefd=False)
+            self._init_writer(master)
 
     # interface
 
@@ -67,58 +188,73 @@ class PseudoTerminal(object):
     def getpid(self):
         return self.pid
 
-    def write(self, data):
-        """Immediately write data to the terminals filedescriptor.
-
-        Data can be a string or a list of strings.
-        """
-        if isinstance(data, basestring):
-            os.write(self.master, data)
-        else:
-            for x in data:
-                os.write(self.master, data)
-        # flush???
-
-    def read(self, timeout=None, additional_fd=None):
-        """Read data from the pty and return it.
+    def fileno(self):
+        return self.master
 
-        Optionally provide a timeout of 0 or more seconds. Return None
-        if no data is available after the timeout. Return also None
-        when an OSError occurs.
+    def _write_failed(self):
+        self.state = 'closed'
 
-        If additional_fd is not None, it should be an int denoting a
-        file descriptor to select on in addition of the master pty.
+    def read(self):
+        """Read the available data from the pty and return it.
 
-        Preferably return the additional_fd integer if there is data
-        on it.
+        Called once the pty is readable, never waits. Return None if
+        no data is available. Return also None when an OSError
+        occurs.
         """
         try:
-            if additional_fd is not None:
-                select_on = [self.master, additional_fd]
-            else:
-                select_on = [self.master]
-
-            res, _, _  = select.select(select_on,[],[],timeout)
-            if res == []:
-                return None # closed???
-            elif additional_fd in res:
-                return additional_fd
-            else:
-                # read
-                res = [os.read(self.master, 4096)]
-
-                # Read more than 4k (the default unchangeble linux buffer
-                # size) of data at once, to be able to deliver bigger
-                # chunks to the emulator
-                while select.select([self.master],[],[],0) == ([self.master],[],[]):
-                    res.append(os.read(self.master, 4096))
-                return "".join(res)
-        except OSError, e:
+            return self._read_available()
+        except (OSError, IOError), e:
             # self.master was closed or reading interrupted by a
             # signal -> application exit
             self.state = 'closed'
             return None
 
+    def _read_available(self):
+        """Read all available data from the pty into the read buffer.
+
+        Read more than 4k (the default unchangeble linux buffer size)
+        of data at once, to be able to deliver bigger chunks to the
+        emulator. Grow the read size while reads fill it completely,
+        shrink it again when the output calms down.
+
+        Never waits for more data to arrive, lagging tells whether
+        more is likely to follow right away.
+        """
+        view = self._buffer_view
+        size = len(self._buffer)
+        pos = 0
+        reads = 0
+        lagging = False
+        try:
+            while pos < size:
+                want = min(self._read_size, size - pos)
+                n = self._reader.readinto(view[pos:pos+want])
+                reads += 1
+                if n is None:
+                    # EAGAIN, no more data available
+                    break
+                elif n == 0:
+                    raise IOError("pty closed")
+                pos += n
+
+                if n == want:
+                    # the reader is lagging behind, read more at once
+                    lagging = True
+                    self._read_size = min(self._read_size * 2, self.MAX_READ_SIZE)
+                elif n < self._read_size // 4:
+                    self._read_size = max(self._read_size // 2, self.MIN_READ_SIZE)
+        except (OSError, IOError), e:
+            if not pos:
+                raise
+            # deliver what we have, the next read will fail again
+
+        self.lagging = lagging
+        if not pos:
+            return None
+
+        self.stats.add_frame(pos, reads)
+        return view[:pos].tobytes()
+
     def set_size(self, lines, columns):
         """Use the TIOCSWINSZ ioctl to change the size of this pty."""
         l, c = lines, columns
@@ -132,7 +268,7 @@ class PseudoTerminal(object):
             self.size = [c, l]
             return True
 
-class SubprocessTerminal(object):
+class SubprocessTerminal(QueuedWriter):
 
     def __init__(self, cmd, size, env):
         # just connect the terminal to a process without using a
@@ -145,33 +281,47 @@ class SubprocessTerminal(object):
                              env=env)
         self.proc = p
         self.state = 'running'
+        self.lagging = False
+        set_nonblocking(p.stdout.fileno())
+        self._init_writer(p.stdin.fileno())
+        # close stdin once the queue is written, see flush
+        self._eof = False
 
-    def kill(self, signal):
+    def kill(self, signal=9):
         if self.state == 'running':
             self.state = 'killed'
-            self.proc.kill(signal)
+            self.proc.send_signal(signal)
 
     def getpid(self):
         return self.proc.pid
 
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
     def write(self, data):
-        if data == '\x03': # ctrl-c
+        """Write data to the process without blocking, see QueuedWriter.write."""
+        if self._eof:
+            return 0
+        elif data == '\x03': # ctrl-c
             self.proc.send_signal(signal.SIGINT)
-            return
+            return self.write_queue_size
         elif data == '\x04': # ctrl-d
-            self.state = 'closed'
-            self.proc.stdin.close()
-            return
+            self._eof = True
+            return self.flush()
         else:
-            if isinstance(data, basestring):
-                self.proc.stdin.write(data)
-            else:
-                for x in data:
-                    self.proc.stdin.write(data)
-            self.proc.stdin.flush()
+            return QueuedWriter.write(self, data)
 
-    def read(self, timeout=None, additional_fd=None):
-        """Read data from the pty and return it."""
+    def flush(self):
+        size = QueuedWriter.flush(self)
+        if self._eof and not size and not self.proc.stdin.closed:
+            self.proc.stdin.close()
+        return size
+
+    def read(self):
+        """Read the available output of the process and return it.
+
+        Return None when no data is available.
+        """
         try:
             data = os.read(self.proc.stdout.fileno(), 8192)
             if data:
@@ -180,6 +330,8 @@ class SubprocessTerminal(object):
                 self.state = 'closed'
                 return None
         except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return None
             # stdout was closed or reading interrupted by a
             # signal -> application exit
             self.state = 'closed'
@@ -191,26 +343,58 @@ class SubprocessTerminal(object):
 
 class AsyncResettableTerminal(object):
 
-    def __init__(self, use_pty, cmd):
-        self.out = chan.Chan()
-        self._in = chan.Chan()
+    # number of output chunks and bytes buffered between the reactor
+    # and the emulator, reading from the client stops when either is
+    # reached so the pty buffer throttles the client
+    OUT_BUFLEN = 64
+    OUT_MAX_BYTES = 1024 * 1024
+    # seconds to wait before retrying to put output onto a full out channel
+    OUT_RETRY_INTERVAL = 0.005
+    # seconds to wait before retrying a write to a client that is
+    # not written through the fd it is read from
+    WRITE_RETRY_INTERVAL = 0.005
+
+    # seconds to hold back output while the client delivers it faster
+    # than it is read, to coalesce it into larger chunks, and the most
+    # bytes held back
+    LATENCY_BUDGET = 0.005
+    COALESCE_MAX_BYTES = 1024 * 1024
+
+    # writable() returns False once this many bytes are waiting to be
+    # written to the client, a ('write-drained',) message is put onto
+    # out as soon as the backlog is down to WRITE_LOW_WATER again
+    WRITE_HIGH_WATER = 64 * 1024
+    WRITE_LOW_WATER = 16 * 1024
+
+    def __init__(self, use_pty, cmd, reactor=None):
+        self.out = chan.Chan(self.OUT_BUFLEN, max_bytes=self.OUT_MAX_BYTES)
 
         self._use_pty = use_pty
         self._cmd = cmd
 
         self._client = None
+        self._client_fd = None
+
+        # all client io happens within the reactor thread, so reads,
+        # writes and resizes are serialized without any locking
+        self._reactor = reactor or get_reactor()
+
+        # output which did not fit into self.out yet
+        self._pending_out = collections.deque()
+        # output held back by _coalesce
+        self._coalesced = []
+        self._coalesced_size = 0
+        self._coalesce_scheduled = False
+        self._reading = False
+        self._events = 0
+        self._write_retry_scheduled = False
+
+        # bytes passed to write which have not been handed to the
+        # client yet, guarded by _write_lock
+        self._write_scheduled = 0
+        self._write_congested = False
+        self._write_lock = threading.Lock()
 
-        # use a pipe to send resize requests to the client_read thread,
-        # to be able to select on both, this pipe and the master pty
-        r,w = os.pipe()
-        self._resize_read  = os.fdopen(r, 'r', 0)
-        self._resize_write = os.fdopen(w, 'w', 0)
-
-        def _in_handler():
-            while True:
-                self._in.get()()
-
-        utils.create_thread(_in_handler)
         self.reset()
 
     def _reset(self):
@@ -218,66 +402,188 @@ class AsyncResettableTerminal(object):
 
         self._client = create_terminal(use_pty=self._use_pty,
                                        cmd=self._cmd)
-
+        self._client_fd = self._client.fileno()
+        self._reactor.register(self._client_fd, self._client_ready)
+        self._reading = True
+        self._events = select.EPOLLIN
+
+    def _client_ready(self, fd, events):
+        if events & select.EPOLLOUT:
+            self._client.flush()
+            self._write_done()
+        if events & ~select.EPOLLOUT:
+            self._client_read()
+
+    def _client_read(self):
         # read from the client and push onto outgoing
-        def _client_read():
-            while True:
-
-                # receive resize events from the resize pipe,
-                # terminal writes from the master pty
-                data = self._client.read(additional_fd=self._resize_read.fileno())
-
-                if data == self._resize_read.fileno():
-                    new_size = self._resize_read.read(10)
-                    lines = int(new_size[:5])
-                    cols  = int(new_size[5:])
-
-                    # read & propagate remaining data
-                    data = self._client.read(timeout=0, additional_fd=None)
-                    if data is not None:
-                        self.out.put(data)
-
-                    # resize
-                    if self._client.set_size(lines, cols):
-                        # inform screen of the new size
-                        self.out.put(('resize', lines, cols))
-
-                elif data is None:
-                    # terminal client closed
-                    self.out.put(None)
-                    return
-
-                else:
-                    self.out.put(data)
+        data = self._client.read()
+        if data is not None:
+            self._coalesce(data)
+        elif self._client.state != 'running':
+            # terminal client closed
+            self._unregister_client()
+            self._output(None)
+
+    def _coalesce(self, data):
+        """Output data, holding it back while the client is lagging.
+
+        Instead of waiting for more data, schedule a timer to output
+        what has been collected after LATENCY_BUDGET seconds. Output
+        right away once the client calms down.
+        """
+        self._coalesced.append(data)
+        self._coalesced_size += len(data)
+        if not self._client.lagging or self._coalesced_size >= self.COALESCE_MAX_BYTES:
+            self._move_coalesced()
+            self._flush_output()
+        elif not self._coalesce_scheduled:
+            self._coalesce_scheduled = True
+            self._reactor.call_later(self.LATENCY_BUDGET, self._coalesce_timeout)
+
+    def _coalesce_timeout(self):
+        self._coalesce_scheduled = False
+        if self._coalesced:
+            self._move_coalesced()
+            self._flush_output()
+
+    def _move_coalesced(self):
+        if self._coalesced:
+            self._pending_out.append(''.join(self._coalesced))
+            self._coalesced = []
+            self._coalesced_size = 0
+
+    def _output(self, data):
+        # keep any held back output in front
+        self._move_coalesced()
+        self._pending_out.append(data)
+        self._flush_output()
+
+    def _flush_output(self):
+        while self._pending_out:
+            try:
+                self.out.put(self._pending_out[0], timeout=0)
+            except chan.Timeout:
+                # the emulator is lagging behind, stop reading from
+                # the client until it has caught up
+                self._set_reading(False)
+                self._reactor.call_later(self.OUT_RETRY_INTERVAL, self._flush_output)
+                return
+            self._pending_out.popleft()
+
+        self._set_reading(True)
+
+    def _set_reading(self, reading):
+        self._reading = reading
+        self._update_events()
+
+    def _update_events(self):
+        if self._client_fd is not None:
+            writing = self._client.write_queue_size
+            if writing and self._client.write_fileno() != self._client_fd:
+                # a subprocess, its stdin is not watched for EPOLLOUT
+                # as it may be closed any time, see SubprocessTerminal.flush
+                writing = False
+                if not self._write_retry_scheduled:
+                    self._write_retry_scheduled = True
+                    self._reactor.call_later(self.WRITE_RETRY_INTERVAL, self._write_retry)
+            events = ((select.EPOLLIN if self._reading else 0) |
+                      (select.EPOLLOUT if writing else 0))
+            if events != self._events:
+                self._events = events
+                self._reactor.modify(self._client_fd, events)
+
+    def _write_retry(self):
+        self._write_retry_scheduled = False
+        if self._client:
+            self._client.flush()
+        self._write_done()
 
-        utils.create_thread(_client_read)
+    def _unregister_client(self):
+        if self._client_fd is not None:
+            self._reactor.unregister(self._client_fd)
+            self._client_fd = None
 
     def _kill(self):
         if self._client:
+            self._unregister_client()
             self._client.kill()
             self._client = None
+            self._write_done()
 
-    def _write(self, data):
-        self._client.write(data)
+    def _write(self, data, size):
+        if self._client:
+            self._client.write(data)
+        with self._write_lock:
+            self._write_scheduled -= size
+        self._write_done()
+
+    def _write_done(self):
+        # wait for the client to become writable again when
+        # data is left in its queue
+        self._update_events()
+
+        with self._write_lock:
+            drained = self._write_congested and self.write_backlog <= self.WRITE_LOW_WATER
+            if drained:
+                self._write_congested = False
+        if drained:
+            self._output(('write-drained',))
 
     def _set_size(self, lines, cols):
-        # write sth to the resize interrupt pipe to sync client and
-        # screen resize
         assert 0 < lines and lines < 99999
         assert 0 < cols  and cols  < 99999
-        self._resize_write.write('%05d%05d' % (int(lines), int(cols)))
-        self._resize_write.flush()
+
+        if self._client_fd is None:
+            # killed or closed, nothing to resize
+            return
+
+        # read & propagate remaining data to sync client and screen
+        # resize, unless reading is paused because the emulator is
+        # lagging behind anyway
+        if self._reading:
+            self._client_read()
+            if self._client_fd is None:
+                return
+
+        # resize
+        if self._client.set_size(lines, cols):
+            # inform screen of the new size
+            self._output(('resize', lines, cols))
 
     # API
 
     def reset(self):
-        self._in.put(self._reset)
+        self._reactor.call(self._reset)
 
     def kill(self):
-        self._in.put(self._kill)
+        self._reactor.call(self._kill)
 
     def write(self, data):
-        self._in.put(lambda : self._write(data))
+        if isinstance(data, basestring):
+            size = len(data)
+        else:
+            size = sum(map(len, data))
+        with self._write_lock:
+            self._write_scheduled += size
+        self._reactor.call(lambda : self._write(data, size))
+
+    @property
+    def write_backlog(self):
+        """The number of bytes written but not yet accepted by the client."""
+        client = self._client
+        return self._write_scheduled + (client.write_queue_size if client else 0)
+
+    def writable(self):
+        """Return False when the client is not keeping up with writes.
+
+        Writers that care about backpressure should stop writing until
+        a ('write-drained',) message appears on out.
+        """
+        with self._write_lock:
+            if self.write_backlog < self.WRITE_HIGH_WATER:
+                return True
+            self._write_congested = True
+            return False
 
     def set_size(self, lines, columns):
-        self._in.put(lambda : self._set_size(lines, columns))
+        self._reactor.call(lambda : self._set_size(lines, columns))
@@ -19,17 +19,16 @@
 from UserList import UserList
 import logging
 import re
+import codecs
 import pkgutil
 
 import pyte
 from pyte.screens import Char, Margins, Cursor
-from pyte import modes as mo, graphics as g, charsets as cs, control as ctrl
+from pyte import modes as mo, graphics as g, charsets as cs
 
 import browserscreen
 import utils
 
-from termiframe import IFRAME_SCRIPT
-
 logger = logging.getLogger(__name__)
 
 # id for the iframe modes:
@@ -39,14 +38,29 @@ IFRAME_DOCUMENT_MODE_ID = 5151
 # cgi-like interface to respond to a previous iframes http requests
 IFRAME_RESPONSE_MODE_ID = 5152
 
+# <script> tags injected into iframes to provide interoperability
+# between the frame and the surrounding terminal (resizing, key
+# handlers, communication-websocket, ...)
+IFRAME_SCRIPT = ('<script type="text/javascript" src="schirm.js"></script>'
+                 '<script type="text/javascript">schirm.initFrame()</script>')
+
 class TermScreen(pyte.Screen):
 
-    def __init__(self, columns, lines):
+    def __init__(self, columns, lines, scrollback_size=0, archive_size=0):
         self.savepoints = []
+        # bound methods for each event name, see dispatch_many
+        self._handlers = {}
+        # the interned style of the cursor attributes, see style
+        self._style_attrs = None
+        self._style = browserscreen.DEFAULT_STYLE
+        # (style, sgr attrs) -> style resulting from the SGR
+        self._sgr_cache = {}
+        # STYLES.evictions when the cached styles were interned
+        self._style_evictions = browserscreen.STYLES.evictions
         # terminal dimensions in characters
         self.lines, self.columns = lines, columns
 
-        self.linecontainer = browserscreen.BrowserScreen()
+        self.linecontainer = browserscreen.BrowserScreen(scrollback_size, archive_size)
 
         # list of drawing events for the cljs screen
         self.events = []
@@ -61,9 +75,37 @@ class TermScreen(pyte.Screen):
         self.reset()
         self.events = []
 
+    @property
+    def style(self):
+        """The style id of the current cursor attributes."""
+        attrs = self.cursor.attrs
+        if attrs is not self._style_attrs or browserscreen.STYLES.evictions != self._style_evictions:
+            self._check_style_evictions()
+            self._style = browserscreen.STYLES.intern(attrs)
+            self._style_attrs = attrs
+        return self._style
+
+    def _check_style_evictions(self):
+        # evicted style ids may have been reused for other styles
+        if browserscreen.STYLES.evictions != self._style_evictions:
+            self._style_evictions = browserscreen.STYLES.evictions
+            self._sgr_cache.clear()
+
     def _flush_events(self):
         self.events.extend(self.linecontainer.pop_events())
 
+    def dispatch_many(self, ops):
+        """Apply a batch of (event, args, flags) operations from a SchirmStream."""
+        handlers = self._handlers
+        for event, args, flags in ops:
+            handler = handlers.get(event)
+            if handler is None:
+                handler = handlers[event] = getattr(self, event, self._ignore_event)
+            handler(*args, **flags)
+
+    def _ignore_event(self, *args, **flags):
+        pass
+
     def pop_events(self):
         self.linecontainer.cursor(self.cursor.y, self.cursor.x)
         self.linecontainer.check_scrollback()
@@ -107,7 +149,7 @@ class TermScreen(pyte.Screen):
            :manpage:`xterm` -- we now know that.
         """
         self._flush_events()
-        self.linecontainer.reset(self.lines)
+        self.linecontainer.reset(self.lines, self.columns)
 
         if self.iframe_mode:
             self.iframe_leave()
@@ -146,10 +188,32 @@ class TermScreen(pyte.Screen):
                   -> but we don't do this here
         :param int lines: number of lines in the new screen.
         :param int columns: number of columns in the new screen.
+
+        Screens that are not reflowed keep the cursor on the last
+        column:
+
+        >>> screen = TermScreen(100, 24)
+        >>> stream = SchirmStream()
+        >>> stream.attach(screen)
+        >>> stream.feed('\x1b[?1049h\x1b[5;81H')
+        >>> screen.resize(24, 80)
+        >>> screen.cursor.y, screen.cursor.x
+        (4, 79)
+
+        Wrapped lines too long to join are not reflowed:
+
+        >>> screen = TermScreen(300, 250)
+        >>> stream = SchirmStream()
+        >>> stream.attach(screen)
+        >>> stream.feed('x' * 72000)
+        >>> screen.resize(250, 200)
+        >>> screen.cursor.y, screen.cursor.x
+        (239, 199)
         """
         self._flush_events()
 
         old_lines = self.lines
+        old_columns = self.columns
 
         self.lines   = (lines   or self.lines)
         self.columns = (columns or self.columns)
@@ -161,7 +225,13 @@ class TermScreen(pyte.Screen):
             # cursor: make sure that it 'stays' on its current line
             cursor_delta = self.linecontainer.resize(old_lines, self.lines, self.columns)
             self.cursor.y += cursor_delta
-            self.cursor.x = min(max(self.cursor.x, 0), self.columns-1)
+            # rewrap lines, x may be columns (a pending wrap) afterwards
+            cursor = self.linecontainer.reflow(
+                old_columns, self.columns, self.cursor.y, min(self.cursor.x, old_columns))
+            if cursor is None:
+                self.cursor.x = min(max(self.cursor.x, 0), self.columns-1)
+            else:
+                self.cursor.y, self.cursor.x = cursor
 
         self.margins = Margins(0, self.lines - 1)
 
@@ -300,6 +370,24 @@ class TermScreen(pyte.Screen):
             self._flush_events()
             self.linecontainer.leave_altbuf_mode()
 
+    def select_graphic_rendition(self, *attrs):
+        """Set display attributes.
+
+        Cache the resulting style for each style and attrs combination
+        and use its interned Char as the new cursor attributes.
+        """
+        key = (self.style, attrs)
+        style = self._sgr_cache.get(key)
+        if style is None:
+            super(TermScreen, self).select_graphic_rendition(*attrs)
+            style = browserscreen.STYLES.intern(self.cursor.attrs)
+            if len(self._sgr_cache) > 1024:
+                self._sgr_cache.clear()
+            self._sgr_cache[key] = style
+
+        self.cursor.attrs = self._style_attrs = browserscreen.STYLES.chars[style]
+        self._style = style
+
     def draw_string(self, string):
         """Like draw, but for a whole string at once.
 
@@ -307,7 +395,7 @@ class TermScreen(pyte.Screen):
         """
 
         def _write_string(s):
-            self.linecontainer.insert_overwrite(self.cursor.y, self.cursor.x, s, self.cursor.attrs)
+            self.linecontainer.insert_overwrite(self.cursor.y, self.cursor.x, s, self.style)
 
         # iframe mode? just write the string
         if self.iframe_mode:
@@ -336,6 +424,7 @@ class TermScreen(pyte.Screen):
                 # remaining chars will be written on subsequent lines
                 i = 0
                 while len(string) > (line_end+(i*self.columns)):
+                    self.linecontainer.set_wrapped(self.cursor.y)
                     self.linefeed()
                     s = string[line_end+(i*self.columns):line_end+((i+1)*self.columns)]
                     _write_string(s)
@@ -367,7 +456,7 @@ class TermScreen(pyte.Screen):
                 # surplus lines move the scrollback if no margin is active
                 self.linecontainer.append_line(self.columns)
             else:
-                self.linecontainer.insert_line(bottom+1, self.cursor.attrs)
+                self.linecontainer.insert_line(bottom+1, self.style)
                 # delete surplus lines to achieve scrolling within in the margins
                 self.linecontainer.remove_line(top)
         else:
@@ -402,7 +491,7 @@ class TermScreen(pyte.Screen):
             for line in range(self.cursor.y,
                               min(bottom + 1, self.cursor.y + count)):
                 self.linecontainer.remove_line(bottom)
-                self.linecontainer.insert_line(line, self.cursor.attrs)
+                self.linecontainer.insert_line(line, self.style)
 
             self.carriage_return()
 
@@ -423,7 +512,7 @@ class TermScreen(pyte.Screen):
             for _ in range(min(bottom - self.cursor.y + 1, count)):
                 self.linecontainer.remove_line(self.cursor.y)
                 # TODO: get and use the attributes for the *last* line
-                self.linecontainer.insert_line(bottom, self.cursor.attrs)
+                self.linecontainer.insert_line(bottom, self.style)
 
             self.carriage_return()
 
@@ -434,9 +523,20 @@ class TermScreen(pyte.Screen):
         forward.
 
         :param int count: number of characters to insert.
+
+        Lines never grow beyond the screen width, however many chars
+        are inserted:
+
+        >>> screen = TermScreen(10, 2)
+        >>> stream = SchirmStream()
+        >>> stream.attach(screen)
+        >>> stream.feed('hello\x1b[1G' + '\x1b[9999@' * 8 + 'x')
+        >>> events = screen.pop_events()
+        >>> screen.linecontainer._line(0).text
+        'x         '
         """
         count = count or 1
-        self.linecontainer.insert(self.cursor.y, self.cursor.x, ' ' * count, self.cursor.attrs)
+        self.linecontainer.insert(self.cursor.y, self.cursor.x, ' ' * count, self.style)
 
     def delete_characters(self, count=None):
         """Deletes the indicated # of characters, starting with the
@@ -467,7 +567,7 @@ class TermScreen(pyte.Screen):
            too all ``erase_*()`` and ``delete_*()`` methods.
         """
         count = count or 1
-        self.linecontainer.insert_overwrite(self.cursor.y, self.cursor.x, ' ' * count, self.cursor.attrs)
+        self.linecontainer.insert_overwrite(self.cursor.y, self.cursor.x, ' ' * count, self.style)
 
     def erase_in_line(self, type_of=0, private=False):
         """Erases a line in a specific way.
@@ -492,7 +592,9 @@ class TermScreen(pyte.Screen):
             start = 0
             end = self.columns
 
-        self.linecontainer.insert_overwrite(self.cursor.y, start, ' ' * (end-start), self.cursor.attrs)
+        self.linecontainer.insert_overwrite(self.cursor.y, start, ' ' * (end-start), self.style)
+        if end == self.columns:
+            self.linecontainer.set_wrapped(self.cursor.y, False)
 
     def erase_in_display(self, type_of=0, private=False):
         """Erases display in a specific way.
@@ -522,7 +624,8 @@ class TermScreen(pyte.Screen):
             s = ' ' * self.columns
             for line in interval:
                 # erase the whole line
-                self.linecontainer.insert_overwrite(line, 0, s, self.cursor.attrs)
+                self.linecontainer.insert_overwrite(line, 0, s, self.style)
+                self.linecontainer.set_wrapped(line, False)
 
             # erase the line with the cursor.
             self.erase_in_line(type_of)
@@ -532,7 +635,7 @@ class TermScreen(pyte.Screen):
                 s = ' ' * self.columns
                 for line in range(self.lines):
                     # erase the whole line
-                    self.linecontainer.insert_overwrite(line, 0, s, self.cursor.attrs)
+                    self.linecontainer.insert_overwrite(line, 0, s, self.style)
             else:
                 # c) erase the whole display ->
                 # Push every visible line to the history == add blank
@@ -640,6 +743,18 @@ class SchirmStream(pyte.Stream):
 
     """An optimized (for the usage in this project) verison pyte.Stream."""
 
+    # Parsed operations are handed to the listener in batches, at the
+    # end of each feed and whenever MAX_OPS have been collected, to
+    # bound the memory used for huge feeds. See dispatch and flush.
+    MAX_OPS = 1024
+
+    def __init__(self):
+        super(SchirmStream, self).__init__()
+        # keeps utf-8 sequences split across two feeds
+        self._decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        # (event, args, flags) operations parsed since the last flush
+        self._ops = []
+
     def close(self):
         """Mark the stream as closed.
 
@@ -647,63 +762,77 @@ class SchirmStream(pyte.Stream):
         fed into this Stream.
         """
         self.dispatch('close_stream')
+        self.flush()
+
+    non_ascii_pattern = re.compile('[\x80-\xff]')
+    def decode(self, data):
+        """Decode utf-8 data, keeping incomplete sequences for the next call.
+
+        Pure ascii strings are returned as they are, without decoding
+        them.
+        """
+        decoder = self._decoder
+        if not decoder.buffer and not self.non_ascii_pattern.search(data):
+            return data
+        return decoder.decode(data)
 
-    stream_esc_pattern = re.compile('|'.join(re.escape(chr(x)) for x in range(32)))
+    stream_esc_pattern = re.compile('[\x00-\x1f]')
     def feed(self, bytes):
         """Perf-optimized feed function.
 
         Like feed() but directly use a stream and do not return until
         everything has been read.
 
-        Work in chunks and try to use python functions to capture
-        huge, escape-less substrings without having to go through the
-        state-machinery (avoiding the function call overhead).
+        Search the whole decoded buffer for control characters and
+        dispatch everything in between as a single draw_string (or
+        append it to the current string), only going through the
+        state-machinery (and its function call overhead) for escape
+        sequences.
         """
-        string_chunksize = 8192
-        stream_chunksize = 128
-        src = bytes.decode('utf-8', 'ignore')
+        src = self.decode(bytes)
+        search_ctrl = self.stream_esc_pattern.search
+        find = src.find
+        consume = self.consume
+        consume_control = self.consume_control
         i = 0
         l = len(src)
         while i < l:
-            if self.state == 'string':
-                # read data fast
-                # TODO: call find directly on src and do not create a chunk
-                chunk = src[i:i+string_chunksize]
-                esc_idx = chunk.find(ctrl.ESC)
+            state = self.state
+            if state == 'stream':
+                m = search_ctrl(src, i)
+                if m is None:
+                    # fast route: the rest of src is clean
+                    self.dispatch("draw_string", src[i:])
+                    break
+                start = m.start()
+                if start > i:
+                    self.dispatch("draw_string", src[i:start])
+                i = consume_control(src, start)
+            elif state == 'string':
+                esc_idx = find('\x1b', i)
                 if esc_idx == -1:
-                    # fast route: chunk is clean and can be appended
-                    # to the current string immediately
-                    self.current.append(chunk)
-                    i += string_chunksize
-                else:
-                    # fallback: only the first chars up to esc_idx are clean
-                    # use the to normal state machine to parse the remaining string
-                    self.current.append(chunk[:esc_idx])
-                    i += esc_idx
-                    self.consume(src[i])
-                    i += 1
-            elif self.state == 'stream':
-                chunk = src[i:i+stream_chunksize]
-                # TODO: do not create a chunk and call search directly on src
-                m = self.stream_esc_pattern.search(chunk)
-                if not m:
-                    # fast route
-                    self.dispatch("draw_string", chunk)
-                    i += stream_chunksize
-                else:
-                    if m.start() > 0:
-                        self.dispatch("draw_string", chunk[:m.start()])
-                    i += m.start()
-                    self.consume(src[i])
-                    i += 1
-            else:
-                char = src[i]
-                if char:
-                    self.consume(char)
-                    i += 1
-                else:
+                    # fast route: the rest of src can be appended to
+                    # the current string immediately
+                    self.current.append(src[i:])
                     break
-        #self._flush_draw()
+                if esc_idx > i:
+                    self.current.append(src[i:esc_idx])
+                # use the normal state machine to parse the escape
+                consume(src[esc_idx])
+                i = esc_idx + 1
+            else:
+                consume(src[i])
+                i += 1
+
+        self.flush()
+
+    def consume_control(self, src, i):
+        """Consume the control char at src[i] in the stream state.
+
+        Return the index of the next char to read.
+        """
+        self.consume(src[i])
+        return i + 1
 
     def consume(self, char):
         # same as super(SchirmStream, self).consume(char) but without
@@ -723,18 +852,111 @@ class SchirmStream(pyte.Stream):
 
     # I use my own dispatch function - I don't need multiple listeners.
     # Ignore the only flag too.
+    # Events are collected and handed to the listener in batches of
+    # at most MAX_OPS, see flush.
     def dispatch(self, event, *args, **kwargs):
+        ops = self._ops
+        if kwargs.get("reset", True):
+            ops.append((event, args, self.flags))
+            self.reset()
+        else:
+            # flags are still being collected for the current sequence
+            ops.append((event, args, dict(self.flags)))
+        if len(ops) >= self.MAX_OPS:
+            self.flush()
+
+    def flush(self):
+        """Hand all operations parsed so far to the listener.
+
+        Use the listeners dispatch_many method if it has one,
+        __before__ and __after__ are not called.
+        """
+        ops = self._ops
+        if not ops:
+            return
+        self._ops = []
+
+        if not self.listeners:
+            logger.error("no listener set")
+            return
+
         (listener, only) = self.listeners[0] # ignore 'only'
-        if self.listeners:
-            handler = getattr(listener, event, None)
-            if handler:
-                if hasattr(listener, "__before__"):
-                    listener.__before__(event)
-                handler(*args, **self.flags)
+        dispatch_many = getattr(listener, 'dispatch_many', None)
+        if dispatch_many:
+            dispatch_many(ops)
+        else:
+            for event, args, flags in ops:
+                handler = getattr(listener, event, None)
+                if handler:
+                    handler(*args, **flags)
+
+class RegexSchirmStream(SchirmStream):
+
+    """A SchirmStream matching whole escape sequences with a single regex.
+
+    Recognizes complete CSI, OSC, charset, sharp and plain escape
+    sequences in one match and dispatches them with their parsed
+    integer parameters. Anything it does not recognize (unknown
+    sequences, sequences interrupted by control chars or split across
+    two feeds) is left to the pyte state machine.
+    """
+
+    sequence_pattern = re.compile(
+        '\x1b(?:'
+        '\\[([?!]?)([0-9;]*)([@-~])' # CSI: private flag, params, function
+        '|\\]([^\x07\x1b]*)(?:\x07|\x1b\\\\)' # OSC, terminated by BEL or ST
+        '|([()])(.)' # charset
+        '|#(.)' # sharp
+        '|([^\\[\\]()#X])' # simple escape sequences
+        ')', re.DOTALL)
+
+    def consume_control(self, src, i):
+        char = src[i]
+        if char == '\x1b':
+            m = self.sequence_pattern.match(src, i)
+            if m and self._dispatch_sequence(m):
+                return m.end()
+        else:
+            event = self.basic.get(char)
+            if event:
+                self.dispatch(event)
+                return i + 1
+
+        self.consume(char)
+        return i + 1
 
-                if hasattr(listener, "__after__"):
-                    listener.__after__(event)
+    def _dispatch_sequence(self, m):
+        """Dispatch the escape sequence matched by sequence_pattern.
 
-            if kwargs.get("reset", True): self.reset()
+        Return False if it is not a known sequence.
+        """
+        private, params, csi_fn, osc, charset_mode, charset, sharp, esc_fn = m.groups()
+        if csi_fn is not None:
+            event = self.csi.get(csi_fn)
+            if event is None:
+                return False
+            if private:
+                self.flags['private'] = True
+            self.dispatch(event, *[min(int(p or 0), 9999) for p in params.split(';')])
+        elif osc is not None:
+            self.dispatch('os_command', osc)
+        elif charset_mode is not None:
+            self.flags['mode'] = charset_mode
+            self.dispatch('set_charset', charset)
+        elif sharp is not None:
+            event = self.sharp.get(sharp)
+            if event is None:
+                return False
+            self.dispatch(event)
         else:
-            logger.error("no listener set")
+            event = self.escape.get(esc_fn)
+            if event is None:
+                return False
+            self.dispatch(event)
+        return True
+
+# available SchirmStream implementations, see Terminal
+STREAMS = {
+    'statemachine': SchirmStream,
+    'regex': RegexSchirmStream,
+}
@@ -88,6 +88,25 @@ def create_thread(target, name=None, daemon=True):
     t.start()
     return t
 
+class Forwarder(object):
+    """Put messages onto a channel in order without blocking the caller.
+
+    Messages wait in an unbounded queue until a single forwarder
+    thread has put them onto the channel.
+    """
+
+    def __init__(self, chan, name=None):
+        self.chan = chan
+        self._queue = Queue.Queue()
+        create_thread(self._run, name=name)
+
+    def put(self, msg):
+        self._queue.put(msg)
+
+    def _run(self):
+        while True:
+            self.chan.put(self._queue.get())
+
 def shorten(s, max=40, more='...'):
     if len(s) > max:
         return "%s%s" % (s[:max-len(more)], more)